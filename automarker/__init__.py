@@ -1 +1,3 @@
+__version__ = '0.1.0'
+
 from .marker import *
\ No newline at end of file
@@ -0,0 +1,299 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+from . import __version__
+
+
+class ResultCache(object):
+    '''
+    On-disk cache of marking results, shared by marking processes.
+
+    The report and record of a submission, see marker.markRecord(), are
+    stored in their own file named by the hash of the submission,
+    the marking script and the automarker version. Files are written
+    atomically, so readers never see a partial report, and the least
+    recently used reports are evicted when the cache grows over its size.
+
+    Each process counts the size of the reports it writes, and reads the
+    total size of the cache from the disk every sync_every writes, so the
+    cache exceeds its size by at most the reports written by the other
+    processes since then.
+    '''
+
+    def __init__(self, directory, max_size = 256 * 1024 * 1024, sync_every = 100):
+        '''
+        Create a new result cache.
+
+        Parameters
+        ----------
+        directory : str
+            the cache directory, created if it doesn't exist
+        max_size : int
+            the maximum total size of the cached reports in bytes
+        sync_every : int
+            the number of reports written by this process between two
+            readings of the total size from the disk
+        '''
+        self.directory = directory
+        self.max_size = max_size
+        self.sync_every = sync_every
+        self.size = None
+        self.writes = 0
+        os.makedirs(directory, exist_ok = True)
+
+
+    def key(self, source_code, script_content):
+        '''
+        Compute the key of a report.
+
+        Parameters
+        ----------
+        source_code : string
+            source code of the submission
+        script_content : string or bytes
+            content of the marking script
+
+        Returns
+        -------
+        str:
+            the cache key
+        '''
+        if isinstance(script_content, str):
+            script_content = script_content.encode('utf-8')
+
+        h = hashlib.sha256()
+        for part in (__version__.encode('utf-8'), script_content, source_code.encode('utf-8')):
+            h.update(str(len(part)).encode('ascii') + b'\0')
+            h.update(part)
+
+        return h.hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+
+    def get(self, key):
+        '''
+        Get a cached record.
+
+        Parameters
+        ----------
+        key : str
+            the cache key
+
+        Returns
+        -------
+        dict:
+            the record, or None if it isn't cached
+        '''
+        path = self.path(key)
+        try:
+            with open(path) as fin:
+                report = json.load(fin)
+        except (OSError, ValueError):
+            return None
+
+        # mark the report as recently used, the report may be evicted meanwhile
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return report
+
+
+    def put(self, key, report):
+        '''
+        Store a record. Records which cannot be serialized as JSON are not cached.
+
+        Parameters
+        ----------
+        key : str
+            the cache key
+        report : dict
+            the record returned by marker.markRecord()
+        '''
+        try:
+            content = json.dumps(report)
+        except (TypeError, ValueError):
+            return
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        try:
+            # a report written again replaces the previous one
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                fout.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self.writes += 1
+        if self.size is None or self.writes % self.sync_every == 0:
+            with self.locked():
+                self.size = self.totalSize()
+        else:
+            self.size += len(content) - replaced
+
+        if self.size > self.max_size:
+            self.evict()
+
+
+    def entries(self):
+        '''
+        List the cached reports as (last used time, size, path).
+        '''
+        entries = []
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return entries
+
+
+    def totalSize(self):
+        return sum(size for _, size, _ in self.entries())
+
+
+    @contextlib.contextmanager
+    def locked(self):
+        '''
+        Hold the lock of the cache directory, so that no other process
+        evicts reports meanwhile.
+        '''
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def evict(self):
+        '''
+        Remove the least recently used reports until the cache uses at most
+        90% of its maximum size. Only one process evicts at a time.
+        '''
+        with self.locked():
+            entries = sorted(self.entries())
+            size = sum(size for _, size, _ in entries)
+            limit = self.max_size * 0.9
+
+            for _, file_size, path in entries:
+                if size <= limit:
+                    break
+                try:
+                    os.remove(path)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                size -= file_size
+
+            self.size = size
+
+
+class CaseStore(object):
+    '''
+    On-disk results of the test cases and unittest classes of each
+    submission, shared by marking processes.
+
+    It is a memo of runtime results like dedup.RuntimeMemo, which outlives
+    the marking run: when the marking script gains or changes a case, the
+    ResultCache misses and the submissions are marked again, but only the
+    new or changed cases run, while the results of the others are read from
+    the store, see FunctionTestCase.identity().
+
+    Each result is stored in its own file, named by the fingerprint of the
+    submission, the key of the case and the automarker version. Deadlines
+    and resource limits are not part of the key, so clear the store when
+    they change.
+    '''
+
+    def __init__(self, directory):
+        '''
+        Create a new case store.
+
+        Parameters
+        ----------
+        directory : str
+            the store directory, created if it doesn't exist
+        '''
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+
+    def path(self, key):
+        fingerprint, case_key = key
+        h = hashlib.sha256(pickle.dumps((__version__, case_key), protocol = 4))
+        return os.path.join(self.directory, fingerprint[:2], fingerprint, h.hexdigest() + '.pickle')
+
+
+    def get(self, key):
+        '''
+        Get a stored result.
+
+        Parameters
+        ----------
+        key : tuple
+            (fingerprint of the submission, key of the case)
+
+        Returns
+        -------
+        any type:
+            the result, or None if it isn't stored
+        '''
+        try:
+            with open(self.path(key), 'rb') as fin:
+                return pickle.load(fin)
+        except Exception:
+            return None
+
+
+    def put(self, key, result):
+        '''
+        Store a result. Results which cannot be pickled are not stored.
+        '''
+        try:
+            content = pickle.dumps(result, protocol = 4)
+        except Exception:
+            return
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -1,6 +1,9 @@
 import ast
+import io
+import time
 import re
-import itertools
+import tokenize
+from collections import Counter
 
 class CompilationChecker(object):
     '''
@@ -19,8 +22,10 @@ class CompilationChecker(object):
 
         Parameters
         ---------
-        func : function
-            Checking function. This function should accept 4 parameters:
+        func : Rule or function
+            A Rule, whose node handlers are dispatched together with the
+            handlers of all the other rules in one traversal of the tree.
+            Or a checking function. This function should accept 4 parameters:
                 source_code (string): the source code of assignment
                 node (ast.Node): abstract syntax root node of parsed source code
                 description (string): the description of this checker
@@ -47,13 +52,14 @@ class CompilationChecker(object):
         bool
             whether the assignemt can pass this checker        
         '''
+        started = time.perf_counter()
         passed = True
         compiled = True
         content = self.assignment.source_code
         reporter = self.assignment.reporter
 
         try:
-            node = ast.parse(content, 'assignment.py')
+            node = self.assignment.tree
         except Exception as e:
             # compile error
             reporter.onCompilationError(e.lineno, e.offset, e.msg)
@@ -61,15 +67,165 @@ class CompilationChecker(object):
 
         if compiled:
             # check all the requirements
-            for checker, description in self.checkers:
-                if not checker(content, node, description, reporter):
-                    passed = False
+            passed = runRules(self.checkers, content, node, reporter)
 
         reporter.onCompilationCheckFinish(compiled)
+        reporter.onCheckerTiming('CompilationChecker', time.perf_counter() - started)
         return not reporter.breakSandbox and compiled
 
 
 
+
+class RuleContext(object):
+    '''
+    The state of a rule while checking one assignment. Problems found by
+    the handlers are buffered here, so each rule reports them in its own
+    order although all the rules share a single traversal.
+    '''
+
+    def __init__(self, source_code, node, description):
+        self.source_code = source_code
+        self.node = node
+        self.description = description
+        self.passed = True
+        self.events = []
+
+
+    def error(self, lineno, offset, msg = None):
+        '''
+        Record a compilation error, the description is used as message by default.
+        '''
+        self.events.append((False, lineno, offset, msg or self.description))
+        self.passed = False
+
+
+    def breakSandbox(self, lineno, offset, msg = None):
+        '''
+        Record an attempt to break the sandbox, the description is used as message by default.
+        '''
+        self.events.append((True, lineno, offset, msg or self.description))
+        self.passed = False
+
+
+    def flush(self, reporter):
+        for sandbox, lineno, offset, msg in self.events:
+            if sandbox:
+                reporter.onBreakSandbox(lineno, offset, msg)
+            else:
+                reporter.onCompilationError(lineno, offset, msg)
+
+        self.events = []
+
+
+class Rule(object):
+    '''
+    A requirement made of node handlers. A handler is a function accepting
+    2 parameters:
+        n (ast.Node): a node of the registered type (or a subclass of it)
+        ctx (RuleContext): the state of this rule for the checked assignment
+
+    A rule can also be called like a checking function, see CompilationChecker.should().
+    '''
+
+    def __init__(self, begin = None, finish = None):
+        '''
+        Create a new rule.
+
+        Parameters
+        ----------
+        begin : function
+            called with the RuleContext before the traversal
+        finish : function
+            called with the RuleContext after the traversal
+        '''
+        self.handlers = []
+        self.begin = begin
+        self.finish = finish
+
+
+    def on(self, node_type, handler):
+        '''
+        Register a handler of a node type.
+
+        Parameters
+        ----------
+        node_type : type
+            subclass of ast.AST
+        handler : function
+            the node handler
+        '''
+        self.handlers.append((node_type, handler))
+        return self
+
+
+    def __call__(self, source_code, node, description, reporter):
+        return runRules([(self, description)], source_code, node, reporter)
+
+
+def runRules(checkers, source_code, node, reporter):
+    '''
+    Check an assignment against rules and checking functions. The handlers
+    of all the rules are dispatched by node type in a single traversal of
+    the tree, checking functions are called as they are.
+
+    Parameters
+    ----------
+    checkers : list of (Rule or function, description)
+        see CompilationChecker.should()
+    source_code : string
+        the source code of assignment
+    node : ast.Node
+        abstract syntax root node of parsed source code
+    reporter : marker.Reporter
+        report generator
+
+    Returns
+    -------
+    bool
+        whether the assignment passes all the checkers
+    '''
+    contexts = {}
+    registered = []
+    for index, (checker, description) in enumerate(checkers):
+        if isinstance(checker, Rule):
+            ctx = RuleContext(source_code, node, description)
+            contexts[index] = ctx
+            if checker.begin:
+                checker.begin(ctx)
+
+            for node_type, handler in checker.handlers:
+                registered.append((node_type, handler, ctx))
+
+    if registered:
+        dispatch = {}
+        for n in ast.walk(node):
+            handlers = dispatch.get(type(n))
+            if handlers is None:
+                handlers = [(handler, ctx) for node_type, handler, ctx in registered
+                            if isinstance(n, node_type)]
+                dispatch[type(n)] = handlers
+
+            for handler, ctx in handlers:
+                handler(n, ctx)
+
+    passed = True
+    for index, (checker, description) in enumerate(checkers):
+        if index in contexts:
+            ctx = contexts[index]
+            if checker.finish:
+                checker.finish(ctx)
+
+            ctx.flush(reporter)
+            if not ctx.passed:
+                passed = False
+
+        elif not checker(source_code, node, description, reporter):
+            passed = False
+
+    return passed
+
+
+
 ############################################
 # Rules
 ############################################
@@ -88,33 +244,27 @@ def NotUseImports(exceptions = []):
 
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
     exceptions = set(exceptions)
 
-    def _useImports(source_code, node, description, reporter):
-        passed = True
+    def _import(n, ctx):
+        if n.names[0].name not in exceptions:
+            ctx.breakSandbox(n.lineno, n.col_offset)
 
-        for n in ast.walk(node):
-            if isinstance(n, ast.Import):
-                if n.names[0].name not in exceptions:
-                    reporter.onBreakSandbox(n.lineno, n.col_offset, description)
-                    passed = False
+    def _importFrom(n, ctx):
+        if n.module not in exceptions:
+            ctx.breakSandbox(n.lineno, n.col_offset)
 
-            elif isinstance(n, ast.ImportFrom):
-                if n.module not in exceptions:
-                    reporter.onBreakSandbox(n.lineno, n.col_offset, description)
-                    passed = False
-                    
-            elif isinstance(n, ast.Name):
-                if n.id == '__import__':
-                    reporter.onBreakSandbox(n.lineno, n.col_offset, description)
-                    passed = False
+    def _name(n, ctx):
+        if n.id == '__import__':
+            ctx.breakSandbox(n.lineno, n.col_offset)
 
-        return passed
-
-    return _useImports
+    return Rule() \
+        .on(ast.Import, _import) \
+        .on(ast.ImportFrom, _importFrom) \
+        .on(ast.Name, _name)
 
 
 def NotUseFuncs(names):
@@ -129,23 +279,16 @@ def NotUseFuncs(names):
 
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
     names = set(names)
 
-    def _notUseFuncs(source_code, node, description, reporter):
-        passed = True
-
-        for n in ast.walk(node):
-            if isinstance(n, ast.Name):
-                if n.id in names:
-                    reporter.onCompilationError(n.lineno, n.col_offset, description)
-                    passed = False
-
-        return passed
+    def _name(n, ctx):
+        if n.id in names:
+            ctx.error(n.lineno, n.col_offset)
 
-    return _notUseFuncs
+    return Rule().on(ast.Name, _name)
 
 
 def NotUsePrint():
@@ -154,8 +297,8 @@ def NotUsePrint():
 
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
     return NotUseFuncs(['print'])
 
@@ -166,8 +309,8 @@ def NotUseInput():
     
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
     return NotUseFuncs(['input', 'raw_input'])
 
@@ -178,23 +321,16 @@ def NotUseEval():
     
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
     names = set(['eval', 'exec', 'compile'])
 
-    def _notUseFuncs(source_code, node, description, reporter):
-        passed = True
+    def _name(n, ctx):
+        if n.id in names:
+            ctx.breakSandbox(n.lineno, n.col_offset)
 
-        for n in ast.walk(node):
-            if isinstance(n, ast.Name):
-                if n.id in names:
-                    reporter.onBreakSandbox(n.lineno, n.col_offset, description)
-                    passed = False
-
-        return passed
-
-    return _notUseFuncs
+    return Rule().on(ast.Name, _name)
 
 
 def HaveDocstrings():
@@ -203,23 +339,16 @@ def HaveDocstrings():
     
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
 
-    def _haveDocstrings(source_code, node, description, reporter):
-        passed = True
-
-        for n in ast.walk(node):
-            if isinstance(n, ast.FunctionDef):
-                doc = ast.get_docstring(n)
-                if not doc:
-                    reporter.onCompilationError(n.lineno, n.col_offset, description)
-                    passed = False
-
-        return passed
+    def _functionDef(n, ctx):
+        doc = ast.get_docstring(n)
+        if not doc:
+            ctx.error(n.lineno, n.col_offset)
 
-    return _haveDocstrings
+    return Rule().on(ast.FunctionDef, _functionDef)
 
 
 def FollowFormattingStyle():
@@ -228,8 +357,8 @@ def FollowFormattingStyle():
     
     Returns
     -------
-    function:
-        checker function
+    Rule:
+        checker rule
     '''
     VARIABLE_NAME_MATCHER = re.compile(r'^[a-z0-9_]+$')
     CONSTANT_NAME_MATCHER = re.compile(r'^[A-Z0-9_]+$')
@@ -239,7 +368,7 @@ def FollowFormattingStyle():
         # binary operators
         ast.Add     : '+',
         ast.Sub     : '-',
-        ast.Mult    : '\*',
+        ast.Mult    : '*',
         ast.Div     : '/',
         ast.FloorDiv: '//',
         ast.Mod     : '%',
@@ -258,81 +387,127 @@ def FollowFormattingStyle():
         ast.GtE     : '>='
     }
 
-    def _checkOps(lines, line_index, ops):
-        for perm_ops in itertools.permutations(ops):
-            regex = r'.*\s' + r'\s.*\s'.join([re.escape(op) for op in perm_ops]) + r'\s.*'
-            if re.match(regex, lines[line_index]):
-                return True
-                
-        return False
+    SPACED_OPS = set(OP_MAP.values()) | set(['='])
+    # operators inside the replacement fields of an f-string token
+    SPACED_OP_MATCHER = re.compile(
+        r'(?<=\s)(' + '|'.join(re.escape(op) for op in sorted(SPACED_OPS, key = len, reverse = True)) + r')(?=\s)')
 
-    def _follorFormattingStyle(source_code, node, description, reporter):
-        passed = True
-        # check variable names and parameter names
-        def checkName(n, name):
-            if  not VARIABLE_NAME_MATCHER.match(name) \
-            and not CONSTANT_NAME_MATCHER.match(name):
-                reporter.onCompilationError(n.lineno, n.col_offset, 
-                    'Variable name doesn\'t follow formatting style: ' + name)
-                return False
-            return True
+    def _scanTokens(source_code):
+        '''
+        Scan the source code once, token by token. Returns the indexes of
+        the lines indented by tabs, the indexes of the lines longer than
+        80 characters and the number of each operator surrounded by blank
+        spaces on each line.
+        '''
+        tab_lines = []
+        long_lines = []
+        spaced_ops = Counter()
 
-        for n in ast.walk(node):
-            if isinstance(n, ast.Assign):
-                for name in [t.id for t in n.targets if isinstance(t, ast.Name)]:
-                    if not checkName(n, name):
-                        passed = False
+        def stringPrefix(string):
+            # the letters before the opening quote, such as rb or f
+            return string[:len(string) - len(string.lstrip('rRbBuUfF'))]
 
-            elif isinstance(n, ast.FunctionDef):
-                if not checkName(n, n.name):
-                    passed = False
+        lines = io.StringIO(source_code)
+        line_index = [0]
 
-                for arg in n.args.args:
-                    if not checkName(n, arg.arg):
-                        passed = False
+        def readline():
+            physical_line = lines.readline()
+            if physical_line:
+                l = physical_line[:-1] if physical_line.endswith('\n') else physical_line
+                if TAB_MATCHER.match(l):
+                    tab_lines.append(line_index[0])
+                if len(l) > 80:
+                    long_lines.append(line_index[0])
+
+                line_index[0] += 1
+            return physical_line
+
+        try:
+            for tok in tokenize.generate_tokens(readline):
+                if tok.type == tokenize.STRING and 'f' in stringPrefix(tok.string).lower():
+                    row, last = tok.start[0], 0
+                    for m in SPACED_OP_MATCHER.finditer(tok.string):
+                        row += tok.string.count('\n', last, m.start())
+                        last = m.start()
+                        spaced_ops[row - 1, m.group(1)] += 1
+                    continue
+
+                if tok.type != tokenize.OP or tok.string not in SPACED_OPS:
+                    continue
+
+                (row, start), (_, end) = tok.start, tok.end
+                line = tok.line.rstrip('\n')
+                if  start > 0 and line[start - 1].isspace() \
+                and end < len(line) and line[end].isspace():
+                    spaced_ops[row - 1, tok.string] += 1
+        except (tokenize.TokenError, SyntaxError):
+            pass
+
+        # lines left by an unfinished token stream
+        while readline():
+            pass
+
+        return tab_lines, long_lines, spaced_ops
+
+    # check variable names and parameter names
+    def checkName(n, name, ctx):
+        if  not VARIABLE_NAME_MATCHER.match(name) \
+        and not CONSTANT_NAME_MATCHER.match(name):
+            ctx.error(n.lineno, n.col_offset,
+                'Variable name doesn\'t follow formatting style: ' + name)
+
+    def _begin(ctx):
+        ctx.op_lines = {}
+
+    def _node(n, ctx):
+        if hasattr(n, 'lineno'):
+            index = n.lineno - 1
+            if index not in ctx.op_lines:
+                ctx.op_lines[index] = []
+
+    def _assign(n, ctx):
+        for name in [t.id for t in n.targets if isinstance(t, ast.Name)]:
+            checkName(n, name, ctx)
+
+        ctx.op_lines[n.lineno - 1].append('=')
+
+    def _functionDef(n, ctx):
+        checkName(n, n.name, ctx)
+
+        for arg in n.args.args:
+            checkName(n, arg.arg, ctx)
+
+    def _binOp(n, ctx):
+        if type(n.op) in OP_MAP:
+            ctx.op_lines[n.lineno - 1].append(OP_MAP[type(n.op)])
+
+    def _compare(n, ctx):
+        for op in n.ops:
+            if type(op) in OP_MAP:
+                ctx.op_lines[n.lineno - 1].append(OP_MAP[type(op)])
+
+    def _finish(ctx):
+        tab_lines, long_lines, spaced_ops = _scanTokens(ctx.source_code)
 
-        lines = source_code.split('\n')
-        
         # check tabs
-        for i, l in enumerate(lines):
-            if TAB_MATCHER.match(l):
-                reporter.onCompilationError(i+1, 0, 'Do not use tab to indent. Use 4 spaces instead.')
-                passed = False
+        for i in tab_lines:
+            ctx.error(i+1, 0, 'Do not use tab to indent. Use 4 spaces instead.')
 
         # check line length < 80
-        for i, l in enumerate(lines):
-            if len(l) > 80:
-                reporter.onCompilationError(i+1, 0, 'Each line must be less than 80 characters long including spaces.')
-                passed = False
+        for i in long_lines:
+            ctx.error(i+1, 0, 'Each line must be less than 80 characters long including spaces.')
 
         # check space between op
-        op_lines = {}
-
-        for n in ast.walk(node):
-            if hasattr(n, 'lineno'):
-                index = n.lineno - 1
-                if index not in op_lines:
-                    op_lines[index] = []
-
-            if isinstance(n, ast.BinOp):
-                if type(n.op) in OP_MAP:
-                    op_lines[index].append(OP_MAP[type(n.op)])
-
-            elif isinstance(n, ast.Compare):
-                for op in n.ops:
-                    if type(op) in OP_MAP:
-                        op_lines[index].append(OP_MAP[type(op)])
-
-            elif isinstance(n, ast.Assign):
-                op_lines[index].append('=')
-
-        for line_index, ops in op_lines.items():
-            if len(ops) != 0:
-                if not _checkOps(lines, line_index, ops):
-                    reporter.onCompilationError(line_index + 1, 0, 
+        for line_index, ops in ctx.op_lines.items():
+            for op, count in Counter(ops).items():
+                if spaced_ops[line_index, op] < count:
+                    ctx.error(line_index + 1, 0,
                         'There should be a blank space before and after every operator')
-                    passed = False
-
-        return passed
-
-    return _follorFormattingStyle   
+                    break
+
+    return Rule(_begin, _finish) \
+        .on(ast.AST, _node) \
+        .on(ast.Assign, _assign) \
+        .on(ast.FunctionDef, _functionDef) \
+        .on(ast.BinOp, _binOp) \
+        .on(ast.Compare, _compare)
@@ -0,0 +1,121 @@
+import ast
+import hashlib
+
+
+class _DocstringRemover(ast.NodeTransformer):
+
+    def visit_Module(self, node):
+        return self._strip(node)
+
+
+    def visit_ClassDef(self, node):
+        return self._strip(node)
+
+
+    def visit_FunctionDef(self, node):
+        return self._strip(node)
+
+
+    def visit_AsyncFunctionDef(self, node):
+        return self._strip(node)
+
+
+    def _strip(self, node):
+        self.generic_visit(node)
+        body = node.body
+        if  body and isinstance(body[0], ast.Expr) \
+        and isinstance(body[0].value, ast.Constant) \
+        and isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+
+        return node
+
+
+def fingerprint(source_code, dependencies = [], positions = False):
+    '''
+    Compute the fingerprint of the normalized syntax tree of source code.
+    Submissions which only differ in comments, blank spaces and docstrings
+    have the same fingerprint, so they behave the same when they run.
+
+    Parameters
+    ----------
+    source_code : string
+        source code
+    dependencies : list of modules
+        assignment dependency modules
+    positions : bool
+        if it is true, the line and column of each statement and expression
+        are part of the fingerprint, so that submissions with the same
+        fingerprint also have the same tracebacks
+
+    Returns
+    -------
+    str:
+        the fingerprint, or None if the source code cannot be parsed
+    '''
+    try:
+        tree = _DocstringRemover().visit(ast.parse(source_code))
+    except (SyntaxError, ValueError):
+        return None
+
+    dump = ast.dump(tree, annotate_fields = False, include_attributes = positions)
+    h = hashlib.sha256(dump.encode('utf-8'))
+    for dependency in dependencies:
+        h.update(b'\0' + dependency.__name__.encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def groupByFingerprint(filepaths):
+    '''
+    Group files by the fingerprint of their source code, see fingerprint().
+    Files which cannot be read or parsed are in groups of their own.
+
+    Parameters
+    ----------
+    filepaths : list of str
+        paths of the source files
+
+    Returns
+    -------
+    list of list of str:
+        the groups, in order of their first file
+    '''
+    groups = {}
+    for filepath in filepaths:
+        try:
+            with open(filepath) as fin:
+                key = fingerprint(fin.read())
+        except (OSError, UnicodeDecodeError):
+            key = None
+
+        if key is None:
+            key = ('file', filepath)
+        groups.setdefault(key, []).append(filepath)
+
+    return list(groups.values())
+
+
+class RuntimeMemo(object):
+    '''
+    In-memory results of test cases and unittest classes, shared by
+    assignments with the same fingerprint so that only the first of them
+    runs in a sandbox.
+    '''
+
+    def __init__(self):
+        self.results = {}
+
+
+    def get(self, key):
+        '''
+        Get a stored result, or None.
+        '''
+        return self.results.get(key)
+
+
+    def put(self, key, result):
+        '''
+        Store a result.
+        '''
+        self.results[key] = result
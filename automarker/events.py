@@ -0,0 +1,104 @@
+'''
+Compact events streamed from sandboxes to the marking process.
+
+An event is a tuple (kind, function name, detail). A sandbox sends each
+event as soon as it happens, so the events sent before a timeout or a crash
+are kept, and the marking process folds them into its Reporter.
+'''
+
+# kinds of events
+PASS    = 0     # a test passed
+FAIL    = 1     # a test failed, the detail is its truncated description
+ERROR   = 2     # a test raised an error, the detail is its truncated description
+LIMIT   = 3     # a test exceeded a resource limit, the detail is the resource
+TIMEOUT = 4     # the sandbox was stopped at its deadline
+END     = 5     # the sandbox finished, the detail is its (wall, cpu, output, profile), see caseTiming()
+
+# the maximum length of the detail of an event
+DETAIL_LIMIT = 2000
+
+# the maximum length of the repr of the return value of a failed case
+REPR_LIMIT = 200
+
+
+def truncate(text, limit = DETAIL_LIMIT):
+    '''
+    Shorten a text by cutting its middle, keeping the beginning and the
+    end, where tracebacks have their most useful lines.
+    '''
+    if len(text) <= limit:
+        return text
+
+    half = (limit - 5) // 2
+    return text[:half] + ' ... ' + text[-half:]
+
+
+class FailedReturn(object):
+    '''
+    Stands for the return value of a failed function case, sent by a sandbox
+    instead of the value: the name of its type and its truncated repr.
+    '''
+
+    def __init__(self, value, limit = REPR_LIMIT):
+        self.type_name = type(value).__name__
+        try:
+            text = repr(value)
+        except Exception:
+            text = '<{}>'.format(self.type_name)
+
+        self.text = truncate(text, limit)
+
+
+    def __repr__(self):
+        return self.text
+
+
+class EventStream(object):
+    '''
+    Stand-in for a Reporter inside a sandbox, which sends the events it
+    receives over a connection.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+    def send(self, kind, func_name, detail = None):
+        self.conn.send((kind, func_name, detail))
+
+
+    def functionPass(self, func_name):
+        self.send(PASS, func_name)
+
+
+    def onUnittestFail(self, func_name, description):
+        self.send(FAIL, func_name, truncate(description))
+
+
+    def onUnittestError(self, func_name, description):
+        self.send(ERROR, func_name, truncate(description))
+
+
+    def onResourceLimitExceeded(self, func_name, resource):
+        self.send(LIMIT, func_name, resource)
+
+
+    def end(self, wall, cpu, output = None, profile = None):
+        self.send(END, None, (wall, cpu, output, profile))
+
+
+def fold(reporter, events):
+    '''
+    Report a list of events on a Reporter.
+    '''
+    for kind, func_name, detail in events:
+        if kind == PASS:
+            reporter.functionPass(func_name)
+        elif kind == FAIL:
+            reporter.onUnittestFail(func_name, detail)
+        elif kind == ERROR:
+            reporter.onUnittestError(func_name, detail)
+        elif kind == LIMIT:
+            reporter.onResourceLimitExceeded(func_name, detail)
+        elif kind == TIMEOUT:
+            reporter.onFunctionTimeout(func_name)
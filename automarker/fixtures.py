@@ -0,0 +1,395 @@
+'''
+Large test case parameters shared with the sandbox workers.
+
+A Fixture pickles its value once, with pickle protocol 5 and out-of-band
+buffers, into a file of shared memory. The fixture itself is pickled as a
+reference to that file, so sending it to a sandbox worker costs a few bytes,
+and each worker maps the file once and rebuilds a fresh copy of the value
+for every case, which the function under test may modify freely:
+
+    tweets = Fixture(load_tweets('tweets.json'), 'tweets')
+
+    FunctionChecker(a, 'most_popular') \
+        .newCase().when(tweets, '2020-01-01', '2020-12-31').shouldReturn('alice')
+
+Out-of-band buffers, such as the data of numpy arrays, are mapped without
+being copied, and are read-only.
+
+The files are shared by every process using the same value, including the
+processes of other runs. Each of them holds a shared lock on the file while
+it uses it, and the last one removes the file when it exits. The files left
+by killed processes, which hold no lock, are removed by the next process
+registering a fixture.
+
+A FileFixture shares the content of a data file the same way, and gives
+each case a fresh file object over it, for functions taking an open file:
+
+    tweets_file = registerFile('tweets.txt')
+
+    FunctionChecker(a, 'read_tweets') \
+        .newCase().when(tweets_file).shouldReturnType(dict)
+'''
+
+import fcntl
+import hashlib
+import io
+import mmap
+from multiprocessing import util
+import os
+import pickle
+import struct
+import tempfile
+
+# shared memory is a file system on Linux
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# prefixes of the fixture files and of the files being written
+PREFIX = 'automarker-fixture-'
+TMP_PREFIX = '.automarker-fixture-'
+
+# (pickle length, number of out-of-band buffers), followed by the length of each buffer
+HEADER = struct.Struct('<QQ')
+LENGTH = struct.Struct('<Q')
+
+# the fixtures mapped by this process, by digest
+_maps = {}
+
+# the content of the file fixtures used by this process, by digest and encoding
+_contents = {}
+
+# the file fixtures registered by this process, see registerFile()
+_files = {}
+
+# [descriptor holding a shared lock, number of fixtures] of each fixture file
+# used by this process, by path
+_held = {}
+
+# whether this process removed the files left by killed processes
+_cleaned = False
+
+
+def _pack(value):
+    buffers = []
+    data = pickle.dumps(value, protocol = 5, buffer_callback = buffers.append)
+    views = [buffer.raw() for buffer in buffers]
+
+    return [HEADER.pack(len(data), len(views))] + \
+           [LENGTH.pack(view.nbytes) for view in views] + [data] + views
+
+
+def _unpack(mapped):
+    view = memoryview(mapped)
+    length, count = HEADER.unpack_from(view)
+    offset = HEADER.size
+
+    sizes = []
+    for _ in range(count):
+        sizes.append(LENGTH.unpack_from(view, offset)[0])
+        offset += LENGTH.size
+
+    data = view[offset:offset + length]
+    offset += length
+
+    buffers = []
+    for size in sizes:
+        buffers.append(view[offset:offset + size])
+        offset += size
+
+    return pickle.loads(data, buffers = buffers)
+
+
+def _map(path, digest):
+    if digest not in _maps:
+        with open(path, 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size == 0:
+                # an empty file cannot be mapped
+                _maps[digest] = b''
+            else:
+                _maps[digest] = mmap.mmap(fin.fileno(), 0, access = mmap.ACCESS_READ)
+
+    return _maps[digest]
+
+
+def _isOpenedFile(path, fd):
+    try:
+        return os.stat(path).st_ino == os.fstat(fd).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _removeUnused(path, fd):
+    # a file is unused when no process holds a shared lock on it
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return
+
+    if _isOpenedFile(path, fd):
+        os.unlink(path)
+
+
+def _removeStale():
+    '''
+    Remove the fixture files left by killed processes.
+    '''
+    for name in os.listdir(SHARED_DIR):
+        if not name.startswith((PREFIX, TMP_PREFIX)):
+            continue
+
+        path = os.path.join(SHARED_DIR, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+
+        try:
+            _removeUnused(path, fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def _hold(path):
+    '''
+    Take a shared lock on an existing fixture file.
+
+    Returns
+    -------
+    int:
+        the descriptor holding the lock, or None if the file doesn't exist
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+
+    # the last process using the file may be removing it
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    if not _isOpenedFile(path, fd):
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _create(path, chunks):
+    '''
+    Write a fixture file and take a shared lock on it.
+
+    Returns
+    -------
+    int:
+        the descriptor holding the lock, or None if another process created
+        the file first
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir = SHARED_DIR, prefix = TMP_PREFIX)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        with os.fdopen(fd, 'wb', closefd = False) as fout:
+            for chunk in chunks:
+                fout.write(chunk)
+
+        os.link(tmp_path, path)
+        return fd
+    except (FileExistsError, FileNotFoundError):
+        # the file was created by another process, or the unfinished file
+        # was taken for a stale one
+        os.close(fd)
+        return None
+    finally:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def _share(chunks):
+    '''
+    Write chunks of bytes to a file of shared memory named by their digest,
+    unless it already exists, and hold it until _release().
+
+    Returns
+    -------
+    tuple:
+        (digest, size, path of the file)
+    '''
+    global _cleaned
+    if not _cleaned:
+        _cleaned = True
+        _removeStale()
+
+    h = hashlib.sha1()
+    for chunk in chunks:
+        h.update(chunk)
+
+    digest = h.hexdigest()
+    size = sum(memoryview(chunk).nbytes for chunk in chunks)
+    path = os.path.join(SHARED_DIR, PREFIX + digest)
+    while path not in _held:
+        fd = _hold(path)
+        if fd is None:
+            fd = _create(path, chunks)
+        if fd is not None:
+            _held[path] = [fd, 0]
+
+    _held[path][1] += 1
+    return digest, size, path
+
+
+def _release(path):
+    '''
+    Stop using a fixture file, and remove it if no other process uses it.
+    '''
+    held = _held.get(path)
+    if held is None:
+        return
+
+    held[1] -= 1
+    if held[1] > 0:
+        return
+
+    del _held[path]
+    try:
+        _removeUnused(path, held[0])
+    finally:
+        os.close(held[0])
+
+
+def _loadFixture(path, digest):
+    '''
+    Rebuild the value of a fixture, see Fixture.__reduce__().
+    '''
+    return _unpack(_map(path, digest))
+
+
+def _openFileFixture(path, digest, encoding, name):
+    '''
+    Open a fresh file object over a file fixture, see FileFixture.__reduce__().
+    '''
+    key = (digest, encoding)
+    if key not in _contents:
+        # mapped once, then shared by the file objects of every case
+        content = _map(path, digest)[:]
+        _contents[key] = content if encoding is None else content.decode(encoding)
+
+    if encoding is None:
+        f = io.BytesIO(_contents[key])
+    else:
+        f = io.StringIO(_contents[key])
+
+    f.name = name
+    return f
+
+
+class Fixture(object):
+    '''
+    A large parameter or expected value of test cases, registered once
+    and mapped by the sandbox workers instead of being sent to them.
+    '''
+
+    def __init__(self, value, name = 'fixture'):
+        '''
+        Register a new fixture. Fixtures of the same value share their file.
+
+        Parameters
+        ----------
+        value : any type
+            the value, which can be pickled
+        name : str
+            the name of the fixture in reports
+        '''
+        self.name = name
+        self.digest, self.size, self.path = _share(_pack(value))
+        self._hold()
+
+
+    def _hold(self):
+        # released when this process exits, including the processes started
+        # by multiprocessing, which skip atexit
+        self.owner = os.getpid()
+        util.Finalize(None, self.close, exitpriority = -1)
+
+
+    def __reduce__(self):
+        return _loadFixture, (self.path, self.digest)
+
+
+    def __repr__(self):
+        return '<{}>'.format(self.name)
+
+
+    def load(self):
+        '''
+        Rebuild a fresh copy of the value.
+        '''
+        return _loadFixture(self.path, self.digest)
+
+
+    def close(self):
+        '''
+        Stop using the file of this fixture, which is removed if no other
+        fixture or process uses it. The workers which already mapped it
+        keep their mapping.
+        '''
+        if self.owner == os.getpid():
+            self.owner = None
+            _release(self.path)
+
+
+class FileFixture(Fixture):
+    '''
+    A data file shared with the sandbox workers. Each case receives a fresh
+    file object over the content, read from the disk once.
+    '''
+
+    def __init__(self, filepath, binary = False, encoding = 'utf-8'):
+        '''
+        Register a new file fixture, see also registerFile().
+
+        Parameters
+        ----------
+        filepath : str
+            path of the data file
+        binary : bool
+            if it is true, cases receive an io.BytesIO, otherwise an
+            io.StringIO of the decoded content
+        encoding : str
+            the encoding of a text file
+        '''
+        with open(filepath, 'rb') as fin:
+            content = fin.read()
+
+        self.name = os.path.basename(filepath)
+        self.encoding = None if binary else encoding
+        self.digest, self.size, self.path = _share([content])
+        self._hold()
+
+
+    def __reduce__(self):
+        return _openFileFixture, (self.path, self.digest, self.encoding, self.name)
+
+
+    def load(self):
+        '''
+        Open a fresh file object over the content.
+        '''
+        return _openFileFixture(self.path, self.digest, self.encoding, self.name)
+
+
+def registerFile(filepath, binary = False, encoding = 'utf-8'):
+    '''
+    Get the file fixture of a data file, registering it the first time.
+    The file is read again only if it changes.
+
+    Returns
+    -------
+    FileFixture:
+        the file fixture
+    '''
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size, binary, encoding)
+    if key not in _files:
+        _files[key] = FileFixture(filepath, binary, encoding)
+
+    return _files[key]
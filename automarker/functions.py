@@ -1,11 +1,47 @@
+import asyncio
+import copy
+import os
 import sys
 import imp
 import multiprocessing as mp
+from multiprocessing.connection import wait
 import time
-import queue
 import unittest
 import inspect
 import re
+import contextlib
+import cProfile
+import hashlib
+import pickle
+import random
+
+from . import events
+from .sandbox import SandboxError, SandboxLimits, caseTiming, defaultPool, profileHotspots, \
+    waitReadable
+
+
+def _canonical(value):
+    # the elements of sets are pickled in the order of their hashes, which
+    # differs between processes for strings, so they are sorted instead
+    if isinstance(value, (set, frozenset)):
+        items = [_canonical(item) for item in value]
+        return (type(value).__name__,
+                sorted(items, key = lambda item: pickle.dumps(item, protocol = 4)))
+    if type(value) in (list, tuple):
+        return (type(value).__name__, [_canonical(item) for item in value])
+    if type(value) is dict:
+        return ('dict', [(_canonical(k), _canonical(v)) for k, v in value.items()])
+
+    return value
+
+
+def _stableDigest(value):
+    '''
+    Hash a value the same way in every process, unlike the pickle of
+    a set or a frozenset. Raises an error if the value cannot be pickled.
+    '''
+    return hashlib.sha1(pickle.dumps(_canonical(value), protocol = 4)).hexdigest()
+
 
 class FunctionTestCase(object):
 
@@ -14,6 +50,11 @@ class FunctionTestCase(object):
         self.description = description
         self.args = []
         self.max_running_time = max_running_time
+        self.timing = None
+        self.limit = None
+
+        # the case pickled beforehand by pickleCase(), see MarkingPlan
+        self.payload = None
 
 
     def when(self, *args):
@@ -31,76 +72,217 @@ class FunctionTestCase(object):
 
     def run(self):
         '''
-        Run this test case. This will return two values:
+        Run this test case. This will return three values:
         first return value is whether this function returns successfully;
-        second return value is the original return from this function.
+        second return value is the parameters after calling this function;
+        third return value is the original return from this function.
+        The timing of the run is kept in self.timing, and the resource whose
+        limit was exceeded, if any, in self.limit.
         '''
-        q = mp.Queue()
-
-        def workerFunc():
-            try:
-                r = self.checker.target(*self.args)
-                q.put((True, self.args, r))
-            except Exception:
-                q.put((False, self.args, None))
-
-        worker = mp.Process(target = workerFunc)
-        worker.start()
-
+        checker = self.checker
         try:
-            return q.get(timeout = self.max_running_time)
-        except queue.Empty:
-            while worker.is_alive():
-                worker.terminate()
-
+            success, post_args, r, self.timing, self.limit = checker.pool.call(
+                checker.assignment,
+                checker.func_name,
+                self.args,
+                self.max_running_time,
+                checker.profile)
+            return success, post_args, r
+        except SandboxError as err:
+            self.timing = getattr(err, 'timing', None)
             return False, self.args, None
 
 
-    def shouldReturnType(self, return_type):
+    def runChecked(self):
         '''
-        Set the return type of this test case.
+        Run this test case and check its expectation inside the sandbox, as
+        a batch of one case. Only whether it passed, and the FailedReturn
+        of a failed case, are sent back; the parameters modified by the
+        function are compared inside the sandbox.
+
+        Returns
+        -------
+        tuple:
+            (passed, FailedReturn if it failed, limit, timed out)
+        '''
+        checker = self.checker
+        # the batch is run to its end, so that its worker is kept
+        for _, passed, r, self.timing, self.limit in list(checker.pool.runBatch(
+                checker.assignment, checker.func_name, [self.batchEntry()], checker.profile)):
+            return passed, r, self.limit, self.timing['timeout']
+
+
+    def expect(self, expectation, expected):
+        '''
+        Set the expectation of this test case and check it, or record it
+        if the checker is deferred.
 
         Parameters
         ----------
-        return_type: any type
-            the return type
+        expectation: function
+            module level function accepting 4 parameters:
+                expected (any type): the expected value
+                success (bool): whether the function returns successfully
+                post_args (tuple): the parameters after calling the function
+                r (any type): the return value
+            and returning whether this test case passes
+        expected: any type
+            the expected value
         '''
-        if not self.checker.target:
-            self.checker.reporter.onFunctionTypeCheckingFail(
-                self.checker.func_name, None, return_type)
-            return self.checker
+        self.expectation = expectation
+        self.expected = expected
 
-        success, post_args, r = self.run()
+        if self.checker.calibration is not None and self.checker.target:
+            self.max_running_time = self.checker.calibration.functionDeadline(
+                self.checker.func_name, self.args)
 
-        if success and type(r) == return_type:
-            self.checker.reporter.onFunctionTestCasePassed(self.checker.func_name)
+        if self.checker.deferred:
+            self.checker.cases.append(self)
+            return self.checker
+
+        started = time.perf_counter()
+        if not self.checker.target:
+            self.report(False, found = False)
+        elif self.checker.tripped():
+            self.reportSkipped()
         else:
-            self.checker.reporter.onFunctionTypeCheckingFail(
-                self.checker.func_name,
-                type(r), return_type)
-        
+            outcome = self.recall()
+            if outcome is None:
+                outcome = self.runChecked()
+                self.remember(outcome)
+                self.reportTiming()
+
+            self.checker.countTimeout(outcome)
+            self.report(*outcome[:3], timed_out = outcome[3])
+
+        self.checker.reporter.onCheckerTiming(
+            self.checker.name, time.perf_counter() - started)
         return self.checker
 
 
-    def shouldNotReturn(self):
+    def batchEntry(self):
         '''
-        Set this test case will not return anything.
+        This test case as a case of a sandbox batch, see SandboxPool.runBatch().
         '''
-        if not self.checker.target:
-            self.checker.reporter.onFunctionTypeCheckingFail(
-                self.checker.func_name, None, return_type)
-            return self.checker
+        entry = (self.args, self.expectation, self.expected, self.max_running_time)
+        return entry if self.payload is None else entry + (self.payload,)
 
-        success, post_args, r = self.run()
-        if not success or r:
-            self.checker.reporter.onFunctionTestCaseFail(
+
+    def reportTiming(self):
+        if self.timing:
+            self.checker.reporter.onCaseTiming(
+                self.checker.func_name, self.index, self.description,
+                self.args, self.timing)
+
+
+    def identity(self):
+        '''
+        The stable identity of this test case: a hash of the function name,
+        the parameters, the kind of expectation and the expected value.
+        Returns None if they cannot be pickled.
+        '''
+        try:
+            return _stableDigest((
                 self.checker.func_name,
                 self.args,
-                r, None)
+                self.expectation.__name__,
+                self.expected))
+        except Exception:
+            return None
+
+
+    def recall(self):
+        '''
+        Get the (passed, return value, limit, timed out) of this test case
+        stored by an assignment of the same fingerprint, or None. The cases
+        of a profiled checker always run.
+        '''
+        if self.checker.assignment.memo is None or self.checker.profile:
+            return None
+
+        identity = self.identity()
+        if identity is None:
+            return None
+
+        return self.checker.assignment.recall(('case', identity))
+
+
+    def remember(self, outcome):
+        if self.checker.assignment.memo is None:
+            return
+
+        identity = self.identity()
+        if identity is not None:
+            self.checker.assignment.remember(('case', identity), outcome)
+
+
+    def report(self, passed, r = None, limit = None, found = True, timed_out = False):
+        '''
+        Report the result of this test case.
+
+        Parameters
+        ----------
+        passed: bool
+            whether this test case passed
+        r: FailedReturn
+            the type and the truncated repr of the return value
+        limit: str
+            the resource whose limit was exceeded by this test case
+        found: bool
+            whether the function was found in the assignment
+        timed_out: bool
+            whether this test case was stopped at its deadline
+        '''
+        func_name = self.checker.func_name
+        reporter = self.checker.reporter
+
+        if passed:
+            reporter.onFunctionTestCasePassed(func_name)
+        elif not found:
+            reporter.onCannotFindFunctionError(func_name)
+        elif timed_out:
+            reporter.onFunctionTimeout(func_name)
+        elif limit:
+            reporter.onResourceLimitExceeded(func_name, limit)
+        elif self.expectation is returnsType:
+            reporter.onFunctionTypeCheckingFail(
+                func_name,
+                r.type_name if isinstance(r, events.FailedReturn) else type(r),
+                self.expected,
+                self.args)
         else:
-            self.checker.reporter.onFunctionTestCasePassed(self.checker.func_name)
+            reporter.onFunctionTestCaseFail(
+                func_name,
+                self.args,
+                r, self.expected,
+                modifies = self.expectation is modifiesParams)
 
-        return self.checker
+
+    def reportSkipped(self):
+        '''
+        Report this test case as skipped, because the function timed out
+        too many times.
+        '''
+        self.checker.reporter.onFunctionTestCaseSkipped(self.checker.func_name, self.args)
+
+
+    def shouldReturnType(self, return_type):
+        '''
+        Set the return type of this test case.
+
+        Parameters
+        ----------
+        return_type: any type
+            the return type
+        '''
+        return self.expect(returnsType, return_type)
+
+
+    def shouldNotReturn(self):
+        '''
+        Set this test case will not return anything.
+        '''
+        return self.expect(returnsNothing, None)
 
 
     def shouldReturn(self, value):
@@ -112,23 +294,7 @@ class FunctionTestCase(object):
         value: any type
             the expected return value
         '''
-        if not self.checker.target:
-            self.checker.reporter.onFunctionTestCaseFail(
-                self.checker.func_name,
-                self.args,
-                None, value)
-            return self.checker
-
-        success, post_args, r = self.run()
-        if success and r == value:
-            self.checker.reporter.onFunctionTestCasePassed(self.checker.func_name)
-        else:
-            self.checker.reporter.onFunctionTestCaseFail(
-                self.checker.func_name,
-                self.args,
-                r, value)
-            
-        return self.checker
+        return self.expect(returns, value)
 
 
     def shouldModifyParams(self, *args):
@@ -140,38 +306,41 @@ class FunctionTestCase(object):
         args: any type
             the expected modified paremeters
         '''
-        if not self.checker.target:
-            self.checker.reporter.onFunctionTestCaseFail(
-                self.checker.func_name,
-                self.args,
-                None, value)
-            return self.checker
+        return self.expect(modifiesParams, args)
 
-        success, post_args, r = self.run()
-        
-        passed = True
-        for post_arg, expected_arg in zip(post_args, args):
-            if post_arg != expected_arg:
-                passed = False
-                break
 
-        if success and passed:
-            self.checker.reporter.onFunctionTestCasePassed(self.checker.func_name)
-        else:
-            self.checker.reporter.onFunctionTestCaseFail(
-                self.checker.func_name,
-                self.args,
-                r, args)
-            
-        return self.checker
+############################################
+# Expectations
+############################################
+# These are pickled by reference, so deferred cases can be
+# checked inside the sandbox.
 
 
-def loadFunc(assignment, func_name):
-    module = imp.new_module('assignment')
-    for dependency in assignment.dependencies:
-        module.__dict__[dependency.__name__] = dependency
+def returnsType(expected, success, post_args, r):
+    return success and type(r) == expected
 
-    exec(assignment.source_code, module.__dict__)
+
+def returnsNothing(expected, success, post_args, r):
+    return success and not r
+
+
+def returns(expected, success, post_args, r):
+    return success and r == expected
+
+
+def modifiesParams(expected, success, post_args, r):
+    if not success:
+        return False
+
+    for post_arg, expected_arg in zip(post_args, expected):
+        if post_arg != expected_arg:
+            return False
+
+    return True
+
+
+def loadFunc(assignment, func_name):
+    module = assignment.module
 
     if hasattr(module, func_name):
         return getattr(module, func_name)
@@ -181,7 +350,8 @@ def loadFunc(assignment, func_name):
 
 class FunctionChecker(object):
 
-    def __init__(self, assignment, func_name):
+    def __init__(self, assignment, func_name, pool = None, deferred = False, calibration = None,
+                 max_timeouts = None, profile = False):
         '''
         Create a new function checker.
 
@@ -191,14 +361,362 @@ class FunctionChecker(object):
             the assignment to be checked
         func_name : str
             the name of function to be checked
+        pool : SandboxPool
+            the sandbox workers running the test cases,
+            the pool shared by the whole process is used by default
+        deferred : bool
+            if it is true, test cases are only recorded and all of them
+            are run as one batch by check()
+        calibration : Calibration
+            if it is given, the deadline of each test case is calibrated
+            from the running time of a reference solution on the same
+            case, instead of max_running_time
+        max_timeouts : int
+            if it is given, the test cases following max_timeouts timed out
+            cases of this function are skipped without being run
+        profile : bool
+            if it is true, the test cases are run under cProfile inside the
+            sandbox, and the functions of the submission taking the most
+            time are shown by the verbose report, see profileHotspots()
         '''
+        started = time.perf_counter()
         self.func_name = func_name
+        self.name = 'FunctionChecker({})'.format(func_name)
+        self.assignment = assignment
         self.reporter = assignment.reporter
-        self.target = loadFunc(assignment, func_name)
+        self.loaded = False
+        self._target = None
+        self.pool = pool or defaultPool()
+        self.deferred = deferred
+        self.calibration = calibration
+        self.max_timeouts = max_timeouts
+        self.profile = profile
+        self.timeouts = 0
+        self.cases = []
+        self.case_count = 0
+
+        self.reporter.onCheckerTiming(self.name, time.perf_counter() - started)
+
+
+    @property
+    def target(self):
+        '''
+        The function of the assignment, or None if it cannot be found. The
+        body of the assignment module runs at the first use, see loadAsync().
+        '''
+        if not self.loaded:
+            self._target = loadFunc(self.assignment, self.func_name)
+            self.loaded = True
+
+        return self._target
+
+
+    async def loadAsync(self):
+        '''
+        Load the function of the assignment in a thread of the default
+        executor, so that the body of the assignment module never runs on
+        the event loop.
+        '''
+        if not self.loaded:
+            await asyncio.get_running_loop().run_in_executor(None, lambda: self.target)
 
 
     def newCase(self, description = ''):
-        return FunctionTestCase(self, description)
+        case = FunctionTestCase(self, description)
+        case.index = self.case_count
+        self.case_count += 1
+        return case
+
+
+    def shouldMatchReference(self, reference_cases):
+        '''
+        Check this function against a reference function on generated
+        inputs, as one test case. All the inputs are sent to one sandbox as
+        a batch, and the smallest failing input is reported.
+
+        Parameters
+        ----------
+        reference_cases : ReferenceCases
+            the generated inputs and the outputs of the reference
+
+        Returns
+        -------
+        FunctionChecker:
+            this checker
+        '''
+        started = time.perf_counter()
+        if not self.target:
+            self.reporter.onCannotFindFunctionError(self.func_name)
+        elif self.tripped():
+            self.reporter.onFunctionTestCaseSkipped(self.func_name, ())
+        else:
+            key = ('reference', self.func_name, reference_cases.key)
+            outcome = self.assignment.recall(key) \
+                if reference_cases.key and not self.profile else None
+            if outcome is None:
+                outcome = self.runReferenceCases(reference_cases)
+                if reference_cases.key:
+                    self.assignment.remember(key, outcome)
+
+            failed, first, timeouts = outcome
+            self.timeouts += timeouts
+            if first is None:
+                self.reporter.onFunctionTestCasePassed(self.func_name)
+            else:
+                index, r, limit, timed_out = first
+                args, _, expected = reference_cases.cases[index]
+                if timed_out:
+                    self.reporter.onFunctionTimeout(self.func_name)
+                elif limit:
+                    self.reporter.onResourceLimitExceeded(self.func_name, limit)
+                else:
+                    self.reporter.onReferenceMismatch(self.func_name, args, r, expected,
+                                                      failed, len(reference_cases.cases),
+                                                      reference_cases.modifies)
+
+        self.reporter.onCheckerTiming(self.name, time.perf_counter() - started)
+        return self
+
+
+    def runReferenceCases(self, reference_cases):
+        '''
+        Run generated inputs in one sandbox batch, until the circuit breaker
+        trips, see max_timeouts.
+
+        Returns
+        -------
+        tuple:
+            (number of failed inputs, (index, return value, limit, timed out)
+            of the first failed input or None, number of timeouts)
+        '''
+        batch = []
+        for args, expectation, expected in reference_cases.cases:
+            if self.calibration is not None:
+                deadline = self.calibration.functionDeadline(self.func_name, args)
+            else:
+                deadline = reference_cases.max_running_time
+            batch.append((args, expectation, expected, deadline))
+
+        failed, first, timeouts = 0, None, 0
+        with contextlib.closing(self.pool.runBatch(
+                self.assignment, self.func_name, batch, self.profile)) as results:
+            for index, passed, r, timing, limit in results:
+                self.reporter.onCaseTiming(self.func_name, self.case_count, 'reference',
+                                           batch[index][0], timing)
+                self.case_count += 1
+
+                if timing['timeout']:
+                    timeouts += 1
+                if not passed:
+                    failed += 1
+                    if first is None:
+                        first = (index, r, limit, timing['timeout'])
+                if self.max_timeouts is not None and self.timeouts + timeouts >= self.max_timeouts:
+                    break
+
+        return failed, first, timeouts
+
+
+    def check(self):
+        '''
+        Run all the recorded test cases in one sandbox and report their
+        results in order. Only needed when the checker is deferred.
+
+        Returns
+        -------
+        bool
+            whether all the test cases passed
+        '''
+        started = time.perf_counter()
+        batch = self.takeBatch()
+        if batch.pending:
+            with contextlib.closing(self.pool.runBatch(
+                    self.assignment, self.func_name, batch.pending, self.profile)) as results:
+                for result in results:
+                    batch.finish(*result)
+                    if self.tripped():
+                        break
+            batch.skipRest()
+
+        self.reporter.onCheckerTiming(self.name, time.perf_counter() - started)
+        return batch.passed()
+
+
+    async def checkAsync(self):
+        '''
+        Run all the recorded test cases like check(), without blocking the
+        event loop. Only the test cases of a deferred checker are awaited,
+        the others have been run by expect() already.
+        '''
+        started = time.perf_counter()
+        await self.loadAsync()
+        batch = self.takeBatch()
+        if batch.pending:
+            async with contextlib.aclosing(self.pool.runBatchAsync(
+                    self.assignment, self.func_name, batch.pending, self.profile)) as results:
+                async for result in results:
+                    batch.finish(*result)
+                    if self.tripped():
+                        break
+            batch.skipRest()
+
+        self.reporter.onCheckerTiming(self.name, time.perf_counter() - started)
+        return batch.passed()
+
+
+    def takeBatch(self):
+        cases, self.cases = self.cases, []
+        return CaseBatch(self, cases, found = bool(self.target))
+
+
+    def tripped(self):
+        '''
+        Whether the following test cases are skipped, see max_timeouts.
+        '''
+        return self.max_timeouts is not None and self.timeouts >= self.max_timeouts
+
+
+    def countTimeout(self, outcome):
+        if outcome[3]:
+            self.timeouts += 1
+
+
+class CaseBatch(object):
+    '''
+    The recorded test cases of a deferred FunctionChecker. The results
+    are reported in order, as soon as all the previous cases are known.
+    '''
+
+    def __init__(self, checker, cases, found = True):
+        self.checker = checker
+        self.cases = cases
+        self.found = found
+        self.outcomes = []
+        self.skipped = set()
+
+        for i, case in enumerate(cases):
+            if not found:
+                outcome = (False, None, None, False)
+            elif checker.tripped():
+                outcome = (False, None, None, False)
+                self.skipped.add(i)
+            else:
+                outcome = case.recall()
+                if outcome is not None:
+                    checker.countTimeout(outcome)
+            self.outcomes.append(outcome)
+
+        self.missing = [i for i, outcome in enumerate(self.outcomes) if outcome is None]
+        self.pending = [cases[i].batchEntry() for i in self.missing]
+        self.reported = 0
+
+        self.flush()
+
+
+    def finish(self, index, passed, r, timing, limit):
+        '''
+        Record the result of a pending case, see SandboxPool.runBatch().
+        '''
+        case = self.cases[self.missing[index]]
+        outcome = (passed, r, limit, timing['timeout'])
+        self.outcomes[self.missing[index]] = outcome
+        case.remember(outcome)
+        case.timing = timing
+        case.reportTiming()
+        self.checker.countTimeout(outcome)
+        self.flush()
+
+
+    def skipRest(self):
+        '''
+        Skip the pending cases which have not been run.
+        '''
+        for i in self.missing:
+            if self.outcomes[i] is None:
+                self.outcomes[i] = (False, None, None, False)
+                self.skipped.add(i)
+
+        self.flush()
+
+
+    def flush(self):
+        while self.reported < len(self.cases) and self.outcomes[self.reported] is not None:
+            case = self.cases[self.reported]
+            if self.reported in self.skipped:
+                case.reportSkipped()
+            else:
+                case.report(*self.outcomes[self.reported][:3], found = self.found,
+                            timed_out = self.outcomes[self.reported][3])
+            self.reported += 1
+
+
+    def passed(self):
+        return all(outcome[0] for outcome in self.outcomes)
+
+
+class ReferenceCases(object):
+    '''
+    Generated test cases with the outputs of a reference function, see
+    FunctionChecker.shouldMatchReference().
+
+    The inputs are generated and the reference is called on them once, when
+    this object is created. Create it at the top of a marking script, so that
+    all the submissions of a cohort share the outputs, including the marking
+    processes of markFolder(). The inputs are sorted by size, so the first
+    failing input of a submission is the smallest one.
+    '''
+
+    def __init__(self, reference, generator, count = 100, seed = 0, modifies = False,
+                 max_running_time = 1, size = None):
+        '''
+        Parameters
+        ----------
+        reference : function
+            the reference function
+        generator : function
+            takes a random.Random and returns the parameters of a case as
+            a tuple, see generators.py. Duplicated inputs, and the inputs
+            the reference raises an error on, are dropped
+        count : int
+            the number of inputs to generate
+        seed : int
+            the seed of the random generator
+        modifies : bool
+            if it is true, the parameters modified by the reference are
+            expected instead of its return value, see shouldModifyParams()
+        max_running_time : float
+            the deadline of each input in seconds
+        size : function
+            the size of the parameters of a case, the length of their
+            repr() by default
+        '''
+        self.reference = reference
+        self.modifies = modifies
+        self.max_running_time = max_running_time
+
+        rng = random.Random(seed)
+        inputs = {}
+        for _ in range(count):
+            args = generator(rng)
+            inputs.setdefault(repr(args), args)
+
+        self.cases = []
+        for args in sorted(inputs.values(), key = size or (lambda args: len(repr(args)))):
+            post_args = copy.deepcopy(args)
+            try:
+                r = reference(*post_args)
+            except Exception:
+                continue
+
+            if modifies:
+                self.cases.append((args, modifiesParams, post_args))
+            else:
+                self.cases.append((args, returns, r))
+
+        try:
+            self.key = _stableDigest(self.cases)
+        except Exception:
+            self.key = None
 
 
 FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
@@ -219,9 +737,10 @@ def parseFuncName(test):
 
 class UnittestResult(unittest.TestResult):
 
-    def __init__(self, reporter):
+    def __init__(self, reporter, limits = None):
         unittest.TestResult.__init__(self)
         self.reporter = reporter
+        self.limits = limits or SandboxLimits()
     
     
     def addFailure(self, test, err):
@@ -240,16 +759,179 @@ class UnittestResult(unittest.TestResult):
 
     def addError(self, test, err):
         func_name = parseFuncName(test.id())
-        self.reporter.onUnittestFail(func_name, 
+        limit = self.limits.exceeded(err[1])
+        if limit:
+            self.reporter.onResourceLimitExceeded(func_name, limit)
+            return
+
+        self.reporter.onUnittestError(func_name, 
              'Test case failed on {}.{}(): \n{}'.format(
                 test.id().split('.')[1],
                 test.id().split('.')[-1], 
                 self._exc_info_to_string(err, test)))
 
 
+def _assignmentModule(code, dependencies, module_name):
+    # the compiled assignment is executed in its own module, since tests may
+    # change the globals seen by the functions of the submission
+    module = imp.new_module(module_name or 'assignment')
+    for dependency in dependencies:
+        module.__dict__[dependency.__name__] = dependency
+
+    exec(code, module.__dict__)
+    return module
+
+
+def _unittestClasses(module, module_name, source):
+    # the unittest module sees the assignment module, or its functions
+    ut = imp.new_module('assignment_unittest_module')
+    if module_name:
+        ut.__dict__[module_name] = module
+    else:
+        for name, value in inspect.getmembers(module, inspect.isfunction):
+            ut.__dict__[name] = value
+
+    exec(source, ut.__dict__)
+    return [obj for name, obj in inspect.getmembers(ut, inspect.isclass)
+            if issubclass(obj, unittest.TestCase)]
+
+
+def _runUnittestClass(conn, limits, case, profile, filename):
+    profiler = cProfile.Profile() if profile else None
+    wall_started, cpu_started = time.perf_counter(), time.process_time()
+    stream = events.EventStream(conn)
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(case)
+    if profiler is None:
+        suite.run(UnittestResult(stream, limits))
+    else:
+        profiler.runcall(suite.run, UnittestResult(stream, limits))
+    stream.end(time.perf_counter() - wall_started, time.process_time() - cpu_started,
+               limits.caseOutput(),
+               profileHotspots(profiler, filename) if profiler else None)
+
+
+def _runForkedUnittest(conn, limits, loaded, module_name, source, qualname, profile):
+    '''
+    Run a unittest class in a worker forked by a zygote, see Zygote.forkTask().
+    The assignment and unittest modules are rebuilt by the worker.
+    '''
+    code, dependencies = loaded
+    limits.confine()
+    limits.startCase()
+    module = _assignmentModule(code, dependencies, module_name)
+    for case in _unittestClasses(module, module_name, source):
+        if case.__qualname__ == qualname:
+            _runUnittestClass(conn, limits, case, profile, code.co_filename if profile else None)
+
+
+class UnittestRun(object):
+    '''
+    A unittest class running in a sandbox, which streams its events.
+    The sandbox is forked by the zygote of the checker if it has one, and
+    by the marking process otherwise.
+    '''
+
+    def __init__(self, checker, case, seconds):
+        '''
+        Start running a unittest class in a sandbox.
+
+        Parameters
+        ----------
+        checker : UnittestChecker
+            the checker of the class
+        case : unittest.TestCase subclass
+            the unittest class
+        seconds : float
+            the maximum running time
+        '''
+        self.case = case
+        self.events = []
+        self.times = None
+        self.started = time.perf_counter()
+        if not self.forkFromZygote(checker, case):
+            self.forkFromMarkingProcess(checker, case)
+        self.spawn = time.perf_counter() - self.started
+        self.deadline = time.perf_counter() + seconds
+
+
+    def forkFromZygote(self, checker, case):
+        '''
+        Returns whether the sandbox was forked by the zygote of the checker.
+        '''
+        if checker.zygote is None:
+            return False
+
+        try:
+            self.conn, self.process = checker.zygote.forkTask(
+                checker.limits, checker.assignment, _runForkedUnittest,
+                (checker.module_name, checker.source, case.__qualname__, checker.profile))
+        except SandboxError:
+            # the zygote has exited
+            return False
+
+        return True
+
+
+    def forkFromMarkingProcess(self, checker, case):
+        self.conn, child_conn = mp.Pipe(duplex = False)
+        filename = checker.assignment.code.co_filename if checker.profile else None
+
+        def workerFunc(case):
+            checker.limits.apply()
+            checker.limits.confine()
+            checker.limits.startCase()
+            _runUnittestClass(child_conn, checker.limits, case, checker.profile, filename)
+
+        self.process = mp.Process(target = workerFunc, args = (case,))
+        self.process.start()
+        child_conn.close()
+
+
+    def receive(self):
+        '''
+        Collect the events sent so far. Returns whether the class has
+        finished, or its sandbox has died.
+        '''
+        try:
+            while self.times is None and self.conn.poll():
+                event = self.conn.recv()
+                if event[0] == events.END:
+                    self.times = event[2]
+                else:
+                    self.events.append(event)
+        except (OSError, EOFError):
+            return True
+
+        return self.times is not None
+
+
+    def result(self):
+        '''
+        Stop the sandbox and return the events of the class and its timing,
+        see sandbox.caseTiming(). A class which has not finished gets a
+        timeout event after the events it sent.
+        '''
+        self.receive()
+        self.conn.close()
+        total = time.perf_counter() - self.started
+        if self.times is not None:
+            wall, cpu, output, profile = self.times
+            return self.events, caseTiming(total, wall, cpu, spawn = self.spawn, output = output,
+                                           profile = profile)
+
+        while self.process.is_alive():
+            self.process.terminate()
+            self.process.join(0.1)
+
+        self.events.append((events.TIMEOUT, parseFuncName(self.case.__name__), None))
+        return self.events, caseTiming(total, spawn = self.spawn, timeout = True)
+
+
 class UnittestChecker(object):
 
-    def __init__(self, assignment, unittest_path, module_name = None, max_running_time = 2):
+    def __init__(self, assignment, unittest_path, module_name = None, max_running_time = 2,
+                 limits = None, calibration = None, processes = None, profile = False,
+                 zygote = None):
         '''
         Create a new function checker based on unittest.
 
@@ -263,74 +945,319 @@ class UnittestChecker(object):
 
         module_name: str
             the name of target module using in unittest file
+
+        limits: SandboxLimits
+            the resource limits of the processes running the tests
+
+        calibration: Calibration
+            if it is given, the deadline of each unittest class is calibrated
+            from the running time of a reference solution on the same class,
+            instead of max_running_time
+
+        processes: int
+            the maximum number of unittest classes running at the same time,
+            the number of cores by default
+
+        profile: bool
+            if it is true, the unittest classes are run under cProfile, and
+            the functions of the submission taking the most time are shown
+            by the verbose report, like FunctionChecker
+
+        zygote: Zygote
+            if it is given, the processes running the tests are forked by it,
+            and rebuild the assignment and unittest modules themselves. The
+            zygote of the default sandbox pool is used by default, see
+            sandbox.configureDefaultPool()
         '''
         self.assignment = assignment
         self.unittest_path = unittest_path
+        self.name = 'UnittestChecker({})'.format(os.path.basename(unittest_path))
         self.module_name = module_name
         self.max_running_time = max_running_time
-        self.cases = []
-
+        self.limits = limits or SandboxLimits()
+        self.calibration = calibration
+        self.processes = processes or mp.cpu_count()
+        self.profile = profile
+        self.zygote = zygote if zygote is not None else defaultPool().zygote
+        self.loaded = False
+        self._cases = []
+        self.source = None
+        self.digest = None
+
+
+    @property
+    def cases(self):
+        '''
+        The unittest classes, loaded at the first use, see load().
+        '''
         self.load()
+        return self._cases
 
 
     def load(self):
-        # create assignment module
-        if self.module_name:
-            module = imp.new_module(self.module_name)
-        else:
-            module = imp.new_module('assignment')
-
-        # add dependencies
-        for dependency in self.assignment.dependencies:
-            module.__dict__[dependency.__name__] = dependency
+        '''
+        Execute the assignment and the unittest module, and collect the
+        unittest classes. It runs once, when the classes are first needed.
+        '''
+        if self.loaded:
+            return
 
-        # execute assignment module
+        self.loaded = True
         try:
-            exec(self.assignment.source_code, module.__dict__)
+            module = _assignmentModule(self.assignment.code, self.assignment.dependencies,
+                                       self.module_name)
         except Exception as err:
             self.assignment.reporter.onRuntimeError(err)
             return
 
-        # create unit test module
-        ut = imp.new_module('assignment_unittest_module')
-        if self.module_name:
-            ut.__dict__[self.module_name] = module
+        with open(self.unittest_path) as fin:
+            self.source = fin.read()
+
+        # an edited unittest file runs again, see caseKey()
+        self.digest = hashlib.sha1(self.source.encode('utf-8')).hexdigest()
+        self._cases = _unittestClasses(module, self.module_name, self.source)
+
+
+    def deadline(self, case):
+        '''
+        The maximum running time of a unittest class in seconds.
+        '''
+        if self.calibration is None:
+            return self.max_running_time
+
+        return self.calibration.unittestDeadline(self, case)
+
+
+    def runCase(self, case):
+        '''
+        Run a unittest class in a sandbox. Returns the events it produced,
+        see events.py, and its timing, see sandbox.caseTiming().
+        '''
+        run = UnittestRun(self, case, self.deadline(case))
+        while not run.receive():
+            remaining = run.deadline - time.perf_counter()
+            if remaining <= 0 or not run.conn.poll(remaining):
+                break
+
+        return run.result()
+
+
+    async def runCaseAsync(self, case):
+        '''
+        Run a unittest class like runCase(), without blocking the event loop.
+        '''
+        run = UnittestRun(self, case, self.deadline(case))
+        while not run.receive():
+            remaining = run.deadline - time.perf_counter()
+            if remaining <= 0 or not await waitReadable(run.conn, remaining):
+                break
+
+        return run.result()
+
+
+    def caseKey(self, case):
+        return ('unittest', os.path.abspath(self.unittest_path), self.digest,
+                self.module_name, case.__qualname__)
+
+
+    def recordCase(self, index, case, case_events, timing):
+        # the events have tracebacks, with the lines of this assignment
+        self.assignment.remember(self.caseKey(case), case_events, positions = True)
+        self.assignment.reporter.onCaseTiming(parseFuncName(case.__name__), index,
+                                              case.__name__, (), timing)
+
+
+    def runCases(self, cases):
+        '''
+        Run unittest classes in sandboxes, at most self.processes at the
+        same time, each one against its own deadline.
+
+        Parameters
+        ----------
+        cases : list of tuple
+            (index, unittest class) of each class to run
+
+        Returns
+        -------
+        dict:
+            the (events, timing) of each index, see runCase()
+        '''
+        results = {}
+        waiting = list(reversed(cases))
+        running = {}
+
+        while waiting or running:
+            while waiting and len(running) < self.processes:
+                index, case = waiting.pop()
+                run = UnittestRun(self, case, self.deadline(case))
+                running[run.conn] = (index, run)
+
+            deadline = min(run.deadline for _, run in running.values())
+            ready = wait(list(running), max(0.0, deadline - time.perf_counter()))
+
+            now = time.perf_counter()
+            for conn, (index, run) in list(running.items()):
+                if (conn in ready and run.receive()) or now >= run.deadline:
+                    del running[conn]
+                    results[index] = run.result()
+
+        return results
+
+
+    async def runCasesAsync(self, cases):
+        '''
+        Run unittest classes like runCases(), without blocking the event loop.
+        '''
+        semaphore = asyncio.Semaphore(self.processes)
+
+        async def run(case):
+            async with semaphore:
+                return await self.runCaseAsync(case)
+
+        results = await asyncio.gather(*[run(case) for _, case in cases])
+        return {index: result for (index, _), result in zip(cases, results)}
+
+
+    def pendingCases(self):
+        '''
+        The events of each unittest class stored by an assignment of the
+        same fingerprint or None, and the (index, class) of the others.
+        The classes of a profiled checker always run.
+        '''
+        if self.profile:
+            case_events = [None] * len(self.cases)
         else:
-            for name, value in inspect.getmembers(module, inspect.isfunction):
-                ut.__dict__[name] = value
+            case_events = [self.assignment.recall(self.caseKey(case), positions = True)
+                           for case in self.cases]
+        return case_events, [(index, case) for index, case in enumerate(self.cases)
+                             if case_events[index] is None]
 
-        with open(self.unittest_path) as fin:
-            exec(fin.read(), ut.__dict__)
 
-        for name, obj in inspect.getmembers(ut, inspect.isclass):
-            if issubclass(obj, unittest.TestCase):
-                self.cases.append(obj)
+    def replay(self, case_events, results):
+        '''
+        Report the events of the unittest classes in their order.
+        '''
+        reporter = self.assignment.reporter
+        for index, case in enumerate(self.cases):
+            if index in results:
+                case_events[index], timing = results[index]
+                self.recordCase(index, case, case_events[index], timing)
+
+            events.fold(reporter, case_events[index])
+
+
+    async def loadAsync(self):
+        '''
+        Load the unittest classes like load(), in a thread of the default
+        executor, so that the body of the assignment module never runs on
+        the event loop.
+        '''
+        if not self.loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self.load)
 
 
     def check(self):
-        ENDLESS_LOOP = -1
-        SUCCESS = 0
-        FAIL = -2
+        started = time.perf_counter()
+        case_events, pending = self.pendingCases()
+        self.replay(case_events, self.runCases(pending))
+
+        self.assignment.reporter.onCheckerTiming(self.name, time.perf_counter() - started)
+
 
-        q = mp.Queue()
+    async def checkAsync(self):
+        '''
+        Run the unittest classes like check(), without blocking the event loop.
+        '''
+        started = time.perf_counter()
+        await self.loadAsync()
+        case_events, pending = self.pendingCases()
+        self.replay(case_events, await self.runCasesAsync(pending))
 
-        for case in self.cases:
-            func_name = parseFuncName(case.__name__)
+        self.assignment.reporter.onCheckerTiming(self.name, time.perf_counter() - started)
 
-            def workerFunc(case, reporter):
-                suite = unittest.defaultTestLoader.loadTestsFromTestCase(case)
-                result = UnittestResult(reporter)
-                suite.run(result)
-                q.put(reporter)
 
-            worker = mp.Process(target = workerFunc, args = (case, self.assignment.reporter))
-            worker.start()
+class Calibration(object):
+    '''
+    Deadlines of test cases calibrated from a reference solution.
 
+    The reference solution is timed once on each test case and unittest
+    class, and the deadline of a submission on the same case is a multiple
+    of that time, between a floor and a ceiling. Correct submissions finish
+    well within their deadlines, while submissions which never return are
+    stopped after the floor instead of a fixed second. Create it once in a
+    marking script, so that every submission shares the timings.
+    '''
+
+    def __init__(self, reference, multiple = 10, floor = 0.1, ceiling = 10, pool = None):
+        '''
+        Create a new calibration.
+
+        Parameters
+        ----------
+        reference : Assignment
+            the reference solution
+        multiple : float
+            the deadline of a case relative to the running time of the reference
+        floor : float
+            the minimum deadline in seconds, which also covers loading the
+            submission and sending the case to its sandbox
+        ceiling : float
+            the maximum deadline in seconds, also used when the reference
+            does not finish
+        pool : SandboxPool
+            the sandbox workers running the reference,
+            the pool shared by the whole process is used by default
+        '''
+        self.reference = reference
+        self.multiple = multiple
+        self.floor = floor
+        self.ceiling = ceiling
+        self.pool = pool
+        self.times = {}
+
+
+    def deadline(self, seconds):
+        '''
+        The deadline of a case the reference ran in the given seconds,
+        or did not finish if seconds is None.
+        '''
+        if seconds is None:
+            return self.ceiling
+
+        return min(self.ceiling, max(self.floor, seconds * self.multiple))
+
+
+    def functionDeadline(self, func_name, args):
+        '''
+        The deadline of calling a function with the given parameters.
+        '''
+        key = ('function', func_name, pickle.dumps(args, protocol = 4))
+        if key not in self.times:
+            pool = self.pool or defaultPool()
             try:
-                self.assignment.reporter = q.get(timeout = self.max_running_time)
-            except queue.Empty:
-                while worker.is_alive():
-                    worker.terminate()
+                _, _, _, timing, _ = pool.call(self.reference, func_name, args, self.ceiling)
+                self.times[key] = timing['wall']
+            except SandboxError:
+                self.times[key] = None
 
-                self.assignment.reporter.onFunctionTimeout(func_name)
-                
\ No newline at end of file
+        return self.deadline(self.times[key])
+
+
+    def unittestDeadline(self, checker, case):
+        '''
+        The deadline of a unittest class of a UnittestChecker. All the
+        classes of its unittest module are timed at the first call.
+        '''
+        key = checker.caseKey(case)
+        if key not in self.times:
+            reference = UnittestChecker(self.reference, checker.unittest_path,
+                                        checker.module_name, self.ceiling, checker.limits,
+                                        processes = checker.processes,
+                                        zygote = checker.zygote)
+            results = reference.runCases(list(enumerate(reference.cases)))
+            for index, (_, timing) in results.items():
+                self.times[reference.caseKey(reference.cases[index])] = \
+                    None if timing['timeout'] else timing['wall']
+            self.times.setdefault(key, None)
+
+        return self.deadline(self.times[key])
@@ -0,0 +1,71 @@
+'''
+Input generators for differential testing, see functions.ReferenceCases.
+
+A generator takes a random.Random and returns the parameters of one test
+case as a tuple.
+'''
+
+import string
+
+WORDS = ['the', 'cat', 'sat', 'on', 'a', 'mat', 'Python', 'CODE', 'hello', 'world',
+         'x', 'i18n', 'tweet', 'RT', 'http://t.co/abc', 'ok!', "don't", '2024', '...']
+
+NAME_CHARS = string.ascii_letters + string.digits + '_'
+PUNCTUATION = ['', '', '', '.', ',', '!', '?', ':']
+
+
+def randomName(rng, max_length = 8):
+    return ''.join(rng.choice(NAME_CHARS) for _ in range(rng.randint(1, max_length)))
+
+
+def randomTweet(rng, max_words = 12):
+    '''
+    A random tweet of words, @mentions and #hashtags, with punctuation,
+    repeated tags and irregular spaces.
+
+    Parameters
+    ----------
+    rng : random.Random
+        the source of randomness
+    max_words : int
+        the maximum number of words
+
+    Returns
+    -------
+    str:
+        the tweet
+    '''
+    words = []
+    for _ in range(rng.randint(0, max_words)):
+        kind = rng.random()
+        if kind < 0.2:
+            word = '@' + randomName(rng)
+        elif kind < 0.4:
+            word = '#' + randomName(rng)
+        elif kind < 0.45 and words:
+            word = rng.choice(words)
+        else:
+            word = rng.choice(WORDS)
+        words.append(word + rng.choice(PUNCTUATION))
+
+    separator = rng.choice([' ', ' ', ' ', '  '])
+    return separator.join(words)
+
+
+def tweets(rng):
+    '''
+    Parameters of a function taking a tweet, such as extract_mentions().
+    '''
+    return (randomTweet(rng),)
+
+
+def tweetsAndCounts(rng):
+    '''
+    Parameters of a function taking a tweet and a dict of word counts,
+    such as count_words().
+    '''
+    counts = {}
+    for word in rng.sample(WORDS, rng.randint(0, 3)):
+        counts[word.lower()] = rng.randint(1, 5)
+
+    return (randomTweet(rng), counts)
@@ -1,8 +1,22 @@
+import ast
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import contextvars
 from collections import Counter
 import glob
 import os
 import imp
+import marshal
 import os.path
+import multiprocessing as mp
+import queue
+import reprlib
+import threading
+import time
+
+from .dedup import RuntimeMemo, fingerprint, groupByFingerprint
+from .sandbox import sourceKey
 
 SUCCESS = 0
 WARNING = 1
@@ -10,6 +24,34 @@ ERROR   = 2
 
 SPLITTER = '-' * 50
 
+TIMING_FIELDS = ['total', 'wall', 'cpu', 'spawn', 'ipc', 'compare']
+
+# the number of hotspots of each profiled function shown by the verbose report
+HOTSPOTS = 5
+
+
+_short_repr = reprlib.Repr()
+_short_repr.maxstring = 80
+_short_repr.maxother = 80
+
+def shortRepr(value, limit = 80):
+    '''
+    repr() of a value, truncated to limit characters. Large containers
+    are not fully formatted.
+    '''
+    try:
+        text = _short_repr.repr(value)
+    except Exception:
+        text = '<{}>'.format(type(value).__name__)
+
+    if len(text) > limit:
+        text = text[:limit - 3] + '...'
+
+    return text
+
+# file name of the compiled source code of assignments
+SOURCE_FILENAME = '<assignment>'
+
 class Reporter(object):
 
     def __init__(self):
@@ -20,8 +62,15 @@ class Reporter(object):
         self.function_cases = Counter()
         self.passed_cases = Counter()
         self.timeout_funcs = set()
+        self.limit_funcs = {}
+        self.skipped_cases = Counter()
         self.fail_cases = []
         self.runtimeError = False
+        self.case_timings = []
+        self.checker_timings = Counter()
+        self.output_bytes = Counter()
+        self.output_excerpts = {}
+        self.hotspots = {}
 
 
     def onCompilationError(self, lineno, offset, msg):
@@ -63,6 +112,7 @@ class Reporter(object):
 
     def onCannotFindFunctionError(self, func_name):
         self.functionFail(func_name)
+        self.fail_cases.append('{}() cannot be found'.format(func_name))
 
 
     def onFunctionTestCasePassed(self, func_name):
@@ -74,12 +124,40 @@ class Reporter(object):
         self.fail_cases.append(description)
 
 
-    def onFunctionTestCaseFail(self, func_name, args, return_value, excepted_value):
+    def onUnittestError(self, func_name, description):
+        self.onUnittestFail(func_name, description)
+
+
+    def onFunctionTestCaseFail(self, func_name, args, return_value, excepted_value,
+                               modifies = False):
+        self.functionFail(func_name)
+        if modifies:
+            self.fail_cases.append('{}{} should modify the parameters to {}'.format(
+                func_name, shortRepr(args), shortRepr(excepted_value)))
+        else:
+            self.fail_cases.append('{}{} returned {}, expected {}'.format(
+                func_name, shortRepr(args), shortRepr(return_value), shortRepr(excepted_value)))
+
+
+    def onReferenceMismatch(self, func_name, args, return_value, expected, failed, total,
+                            modifies = False):
         self.functionFail(func_name)
+        if modifies:
+            description = '{}{} should modify the parameters to {}'.format(
+                func_name, shortRepr(args), shortRepr(expected))
+        else:
+            description = '{}{} returned {}, expected {}'.format(
+                func_name, shortRepr(args), shortRepr(return_value), shortRepr(expected))
 
+        self.fail_cases.append('{} ({} of {} generated inputs failed)'.format(description, failed, total))
 
-    def onFunctionTypeCheckingFail(self, func_name, return_type, excepted_value):
+
+    def onFunctionTypeCheckingFail(self, func_name, return_type, excepted_value, args = ()):
         self.functionFail(func_name)
+        self.fail_cases.append('{}{} returned {}, expected {}'.format(
+            func_name, shortRepr(args),
+            getattr(return_type, '__name__', return_type),
+            getattr(excepted_value, '__name__', excepted_value)))
 
 
     def onFunctionTimeout(self, func_name):
@@ -88,6 +166,147 @@ class Reporter(object):
         self.fail_cases.append('{}() timeout'.format(func_name))
 
 
+    def onResourceLimitExceeded(self, func_name, resource):
+        self.functionFail(func_name)
+        if resource not in self.limit_funcs.setdefault(func_name, []):
+            self.limit_funcs[func_name].append(resource)
+        self.fail_cases.append('{}() exceeded the {} limit'.format(func_name, resource))
+
+
+    def onFunctionTestCaseSkipped(self, func_name, args):
+        self.functionFail(func_name)
+        self.skipped_cases[func_name] += 1
+        self.fail_cases.append('{}{} skipped after repeated timeouts'.format(
+            func_name, shortRepr(args)))
+
+
+    def onCaseTiming(self, func_name, index, description, args, timing):
+        record = {
+            'function'   : func_name,
+            'case'       : index,
+            'description': description,
+            'args'       : shortRepr(args)
+        }
+        record.update(timing)
+        self.case_timings.append(record)
+
+        if timing.get('output'):
+            # the excerpt of the case which wrote the most is kept
+            self.output_bytes[func_name] += timing['output']
+            if timing['output'] > self.output_excerpts.get(func_name, (0, None))[0]:
+                self.output_excerpts[func_name] = (timing['output'], timing['excerpt'])
+
+        if timing.get('profile'):
+            # the hotspots of the profiled cases of a function are summed
+            spots = self.hotspots.setdefault(func_name, {})
+            for name, line, calls, own, cumulative in timing['profile']:
+                spot = spots.setdefault((name, line), [0, 0.0, 0.0])
+                spot[0] += calls
+                spot[1] += own
+                spot[2] += cumulative
+
+
+    def onCheckerTiming(self, checker_name, seconds):
+        self.checker_timings[checker_name] += seconds
+
+
+    def timingReport(self):
+        '''
+        Machine-readable timings, all times are in seconds.
+
+        Returns
+        -------
+        dict:
+            cases: timing record of each test case run in a sandbox,
+                see sandbox.caseTiming()
+            functions: sum of the records of each function
+            checkers: time spent in each checker
+        '''
+        functions = {}
+        for record in self.case_timings:
+            total = functions.setdefault(record['function'], Counter())
+            total['cases'] += 1
+            total['timeouts'] += int(record['timeout'])
+            total['output'] += record.get('output', 0)
+            for field in TIMING_FIELDS:
+                total[field] += record[field]
+
+        return {
+            'cases'    : list(self.case_timings),
+            'functions': {name: dict(total) for name, total in functions.items()},
+            'checkers' : dict(self.checker_timings)
+        }
+
+
+    def timingMessages(self, slowest = 5):
+        timings = self.timingReport()
+        msg = ['TIMING INFO:', SPLITTER]
+
+        for name, seconds in timings['checkers'].items():
+            msg.append('{}: {:.2f} ms'.format(name, seconds * 1000))
+
+        for name, total in timings['functions'].items():
+            msg.append('{}(): {} cases, '.format(name, total['cases']) + ', '.join(
+                '{} {:.2f} ms'.format(field, total[field] * 1000) for field in TIMING_FIELDS))
+
+        cases = sorted(timings['cases'], key = lambda record: -record['total'])[:slowest]
+        if cases:
+            msg.append('Slowest cases:')
+            for record in cases:
+                msg.append('{}() case {} {}: {:.2f} ms{}'.format(
+                    record['function'], record['case'],
+                    record['description'] or record['args'],
+                    record['total'] * 1000,
+                    ' (timeout)' if record['timeout'] else ''))
+
+        msg.append(SPLITTER)
+        return msg
+
+
+    def hotspotMessages(self, top = HOTSPOTS):
+        msg = []
+        for func_name, spots in self.hotspots.items():
+            msg.append('Hotspots of {}():'.format(func_name))
+            for (name, line), (calls, own, cumulative) in \
+                    sorted(spots.items(), key = lambda spot: -spot[1][1])[:top]:
+                msg.append('  {} (line {}): {} calls, {:.2f} ms own, {:.2f} ms cumulative'.format(
+                    name, line, calls, own * 1000, cumulative * 1000))
+
+        return msg
+
+
+    def record(self):
+        '''
+        A structured summary of the results, which can be serialized as JSON.
+
+        Returns
+        -------
+        dict:
+            compiled: whether the compilation check passed
+            messages: compilation and runtime error messages, like report()
+            functions: passed and total number of cases of each function
+            failures: description of each failed case
+            timeouts: functions which timed out
+            limits: resource limits exceeded by each function
+            skipped: number of cases of each function skipped after
+                repeated timeouts
+            output: bytes written to stdout and stderr by the cases of
+                each function which wrote any
+        '''
+        return {
+            'compiled' : self.compiled,
+            'messages' : [{'err':c, 'msg':m} for c, m in self.msg],
+            'functions': {name: {'passed': self.passed_cases[name],
+                                 'total' : self.function_cases[name]}
+                          for name in self.functions},
+            'failures' : list(self.fail_cases),
+            'timeouts' : [name for name in self.functions if name in self.timeout_funcs],
+            'limits'   : {name: list(resources) for name, resources in self.limit_funcs.items()},
+            'skipped'  : dict(self.skipped_cases),
+            'output'   : dict(self.output_bytes)
+        }
+
+
     def simpleReport(self):
         msg = list(self.msg)
         for func_name in self.function_cases.keys():
@@ -102,6 +321,11 @@ class Reporter(object):
             msg.append((code, 'Testing {}() : {}/{}'.format(func_name, passed, total)))
             if func_name in self.timeout_funcs:
                 msg.append((ERROR, '{}(): Time Limit Exceeded'.format(func_name)))
+            for resource in self.limit_funcs.get(func_name, []):
+                msg.append((ERROR, '{}(): Exceeded the {} limit'.format(func_name, resource)))
+            if self.skipped_cases[func_name]:
+                msg.append((ERROR, '{}(): {} cases skipped after repeated timeouts'.format(
+                    func_name, self.skipped_cases[func_name])))
 
         return [{'err':c, 'msg':m} for c, m in msg]
 
@@ -115,16 +339,82 @@ class Reporter(object):
                 msg.append('Compliation failed')
 
             msg += self.fail_cases
+            for func_name, written in self.output_bytes.items():
+                msg.append('{}() wrote {} bytes of output: {!r}'.format(
+                    func_name, written, self.output_excerpts[func_name][1]))
+            msg += self.hotspotMessages()
             msg.append(SPLITTER)
             msg.append('OUTPUT MSG:')
             msg += [l['msg'] for l in self.simpleReport()]
 
             return msg
+        elif verbose == 2:
+            return self.timingMessages() + self.report(1)
+
+
+_memo = contextvars.ContextVar('memo', default = None)
+
+@contextlib.contextmanager
+def runtimeMemo(memo):
+    '''
+    Make the assignments created in this context share a RuntimeMemo.
+    Each thread and asyncio task has its own context.
+
+    Parameters
+    ----------
+    memo : RuntimeMemo
+        the memo of runtime results
+    '''
+    token = _memo.set(memo)
+    try:
+        yield memo
+    finally:
+        _memo.reset(token)
+
+
+_reporters = contextvars.ContextVar('reporters', default = None)
+
+@contextlib.contextmanager
+def collectReporters():
+    '''
+    Collect the reporters of the assignments created in this context.
+    Each thread and asyncio task has its own context.
+    '''
+    reporters = []
+    token = _reporters.set(reporters)
+    try:
+        yield reporters
+    finally:
+        _reporters.reset(token)
+
+
+def mergeRecords(reporters):
+    '''
+    Merge the records of several reporters, see Reporter.record().
+    '''
+    merged = Reporter().record()
+    for reporter in reporters:
+        record = reporter.record()
+        merged['compiled'] = merged['compiled'] and record['compiled']
+        for field in ('messages', 'failures', 'timeouts'):
+            merged[field] += record[field]
+        for name, counts in record['functions'].items():
+            total = merged['functions'].setdefault(name, {'passed': 0, 'total': 0})
+            total['passed'] += counts['passed']
+            total['total'] += counts['total']
+        for name, resources in record['limits'].items():
+            merged['limits'].setdefault(name, []).extend(resources)
+        for name, count in record['skipped'].items():
+            merged['skipped'][name] = merged['skipped'].get(name, 0) + count
+        for name, written in record['output'].items():
+            merged['output'][name] = merged['output'].get(name, 0) + written
+
+    return merged
 
 
 class Assignment(object):
 
-    def __init__(self, source_code, dependencies = [], reporter = None):
+    def __init__(self, source_code, dependencies = [], reporter = None, memo = None):
         '''
         Create a new marker based on source code.
 
@@ -136,6 +426,10 @@ class Assignment(object):
             assignment dependency modules
         reporter : Reporter or subclass of Reporter
             the reporter used for generating the report of mark
+        memo : RuntimeMemo
+            results of test cases shared with assignments of the same
+            fingerprint, the memo of the current runtimeMemo() context
+            is used by default
         '''
 
         self.source_code = source_code
@@ -146,6 +440,158 @@ class Assignment(object):
         else:
             self.reporter = Reporter()
 
+        self._tree = None
+        self._code = None
+        self._marshaled_code = None
+        self._module = None
+        self._module_error = None
+        # checkers awaited at the same time load the module in their own threads
+        self._module_lock = threading.Lock()
+        self._key = None
+        self._fingerprint = None
+        self._positional_fingerprint = None
+
+        if memo is not None:
+            self.memo = memo
+        else:
+            self.memo = _memo.get()
+
+        reporters = _reporters.get()
+        if reporters is not None:
+            reporters.append(self.reporter)
+
+
+    @property
+    def tree(self):
+        '''
+        The abstract syntax tree of the source code, parsed once.
+        Raises SyntaxError if the source code cannot be parsed.
+        '''
+        if self._tree is None:
+            self._tree = ast.parse(self.source_code, SOURCE_FILENAME)
+
+        return self._tree
+
+
+    @property
+    def code(self):
+        '''
+        The code object of the source code, compiled once from the tree.
+        '''
+        if self._code is None:
+            self._code = compile(self.tree, SOURCE_FILENAME, 'exec')
+
+        return self._code
+
+
+    @property
+    def marshaled_code(self):
+        '''
+        The code object serialized by marshal, sent to sandbox workers.
+        '''
+        if self._marshaled_code is None:
+            self._marshaled_code = marshal.dumps(self.code)
+
+        return self._marshaled_code
+
+
+    @property
+    def module(self):
+        '''
+        The assignment module with the dependencies, whose body is executed
+        once and shared by all the checkers. Checkers which change the module
+        should execute the compiled code in a module of their own, since the
+        functions keep this namespace as their globals. Raises the error of
+        the module body, if any.
+        '''
+        with self._module_lock:
+            if self._module is None:
+                if self._module_error is not None:
+                    raise self._module_error
+
+                module = imp.new_module('assignment')
+                for dependency in self.dependencies:
+                    module.__dict__[dependency.__name__] = dependency
+
+                try:
+                    exec(self.code, module.__dict__)
+                except Exception as err:
+                    self._module_error = err
+                    raise
+
+                self._module = module
+
+            return self._module
+
+
+    @property
+    def key(self):
+        '''
+        The key identifying the source code and dependencies of this assignment.
+        '''
+        if self._key is None:
+            self._key = sourceKey(self.source_code, self.dependencies)
+
+        return self._key
+
+
+    @property
+    def fingerprint(self):
+        '''
+        The fingerprint of the normalized syntax tree, see dedup.fingerprint().
+        '''
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self.source_code, self.dependencies)
+
+        return self._fingerprint
+
+
+    @property
+    def positional_fingerprint(self):
+        '''
+        The fingerprint of the normalized syntax tree and of the positions
+        of its nodes, see dedup.fingerprint().
+        '''
+        if self._positional_fingerprint is None:
+            self._positional_fingerprint = fingerprint(self.source_code, self.dependencies,
+                                                       positions = True)
+
+        return self._positional_fingerprint
+
+
+    def recall(self, key, positions = False):
+        '''
+        Get a runtime result stored by an assignment of the same fingerprint.
+
+        Parameters
+        ----------
+        key : tuple
+            the key of the result in this assignment
+        positions : bool
+            if it is true, the result is only shared with assignments whose
+            code is also at the same lines, such as results with tracebacks
+
+        Returns
+        -------
+        any type:
+            the result, or None
+        '''
+        shared = self.positional_fingerprint if positions else self.fingerprint
+        if self.memo is None or shared is None:
+            return None
+
+        return self.memo.get((shared, key))
+
+
+    def remember(self, key, result, positions = False):
+        '''
+        Store a runtime result for assignments of the same fingerprint, see
+        recall().
+        '''
+        shared = self.positional_fingerprint if positions else self.fingerprint
+        if self.memo is not None and shared is not None:
+            self.memo.put((shared, key), result)
+
 
     def generateReport(self, verbose = 0):
         '''
@@ -157,20 +603,581 @@ class Assignment(object):
             the verbose level. 
             when verbose = 0, only show the result.
             when verbose = 1, show the details.
+            when verbose = 2, also show where the marking time went,
+            see Reporter.timingReport() for the machine-readable timings.
         '''
         return self.reporter.report(verbose)
 
 
-def mark(code, script_filepath):
-    base_dir = os.path.dirname(script_filepath)
-    with open(script_filepath) as fin:
-        # load testing script
-        script_content = fin.read()
-        module = imp.new_module('test_script')
-        exec(script_content, module.__dict__)
+_scripts = {}
+
+def loadScript(script_filepath):
+    '''
+    Load the mark function of a marking script. The script is only
+    executed again when the file changes.
+
+    Parameters
+    ----------
+    script_filepath : str
+        path of the marking script, which defines mark(base_dir, code),
+        either as a function or as a coroutine function
+
+    Returns
+    -------
+    function:
+        the mark function
+    '''
+    stat = os.stat(script_filepath)
+    key = (os.path.abspath(script_filepath), stat.st_mtime_ns, stat.st_size)
+
+    if key not in _scripts:
+        with open(script_filepath) as fin:
+            # load testing script
+            script_content = fin.read()
+            module = imp.new_module('test_script')
+            exec(script_content, module.__dict__)
 
         # get mark function from script file
-        mark_script = getattr(module, 'mark')
+        _scripts[key] = (getattr(module, 'mark'), script_content)
+
+    return _scripts[key][0]
+
+
+def scriptContent(script_filepath):
+    '''
+    Get the content of a marking script as it was loaded by loadScript().
+    '''
+    loadScript(script_filepath)
+    stat = os.stat(script_filepath)
+    return _scripts[(os.path.abspath(script_filepath), stat.st_mtime_ns, stat.st_size)][1]
+
+
+def _recall(cache, code, script_filepath):
+    if cache is None:
+        return None, None
+
+    key = cache.key(code, scriptContent(script_filepath))
+    record = cache.get(key)
+    return key, record if isinstance(record, dict) else None
+
+
+def _newRecord(cache, key, reporters, report):
+    record = mergeRecords(reporters)
+    record['report'] = report
+
+    if cache is not None:
+        cache.put(key, record)
+
+    return record
+
+
+def markRecord(code, script_filepath, cache = None, store = None):
+    '''
+    Mark a submission with a marking script, and summarize the results
+    of the assignments it created.
+
+    Parameters
+    ----------
+    code : string
+        source code of the submission
+    script_filepath : str
+        path of the marking script, which defines mark(base_dir, code)
+    cache : ResultCache
+        if it is given, the stored record is returned for a submission
+        already marked by the same script and automarker version, without
+        running any checker. Files read by the script, such as unittest
+        modules, are not part of the key.
+    store : CaseStore
+        if it is given, the results of the test cases and unittest classes
+        of the submission are stored, and only the cases without a stored
+        result run, see cache.CaseStore
+
+    Returns
+    -------
+    dict:
+        the report returned by the marking script, and the merged
+        records of its assignments, see Reporter.record()
+    '''
+    mark_script = loadScript(script_filepath)
+    key, record = _recall(cache, code, script_filepath)
+    if record is not None:
+        return record
+
+    # mark code
+    memo = store if store is not None else _memo.get()
+    with collectReporters() as reporters, runtimeMemo(memo):
+        report = mark_script(os.path.dirname(script_filepath), code)
+        if asyncio.iscoroutine(report):
+            report = asyncio.run(report)
+
+    return _newRecord(cache, key, reporters, report)
+
+
+def mark(code, script_filepath, cache = None, store = None):
+    '''
+    Mark a submission with a marking script.
+
+    Parameters
+    ----------
+    code : string
+        source code of the submission
+    script_filepath : str
+        path of the marking script, which defines mark(base_dir, code)
+    cache : ResultCache
+        the stored results, see markRecord()
+    store : CaseStore
+        the stored results of each case, see markRecord()
+
+    Returns
+    -------
+    list:
+        the report returned by the marking script
+    '''
+    return markRecord(code, script_filepath, cache, store)['report']
+
+
+async def markAsync(code, script_filepath, cache = None, executor = None, store = None):
+    '''
+    Mark a submission from a running event loop, see mark(). A marking
+    script defining mark() as a coroutine function is awaited, and it
+    should await the checkAsync() of its checkers. Any other script is
+    run in a thread of the executor.
+
+    Parameters
+    ----------
+    code : string
+        source code of the submission
+    script_filepath : str
+        path of the marking script
+    cache : ResultCache
+        the stored results, see markRecord()
+    executor : concurrent.futures.Executor
+        runs the scripts which are not coroutine functions, the default
+        executor of the event loop is used if it is None
+    store : CaseStore
+        the stored results of each case, see markRecord()
+
+    Returns
+    -------
+    list:
+        the report returned by the marking script
+    '''
+    mark_script = loadScript(script_filepath)
+    if not asyncio.iscoroutinefunction(mark_script):
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, mark, code, script_filepath, cache, store)
+
+    key, record = _recall(cache, code, script_filepath)
+    if record is None:
+        memo = store if store is not None else _memo.get()
+        with collectReporters() as reporters, runtimeMemo(memo):
+            report = await mark_script(os.path.dirname(script_filepath), code)
+        record = _newRecord(cache, key, reporters, report)
+
+    return record['report']
+
+
+class MarkerBusy(Exception):
+    '''
+    Raised when an AsyncMarker has too many submissions waiting.
+    '''
+
+
+class AsyncMarker(object):
+    '''
+    Marks submissions for an asyncio application, such as a web service,
+    with a bounded number of submissions marked at the same time.
+    '''
+
+    def __init__(self, script_filepath, concurrency = None, max_pending = None, cache = None,
+                 store = None):
+        '''
+        Parameters
+        ----------
+        script_filepath : str
+            path of the marking script
+        concurrency : int
+            the maximum number of submissions marked at the same time,
+            the number of CPUs by default
+        max_pending : int
+            the maximum number of submissions waiting for their turn,
+            mark() raises MarkerBusy when it is reached. It is four times
+            the concurrency by default
+        cache : ResultCache
+            the stored results, see markRecord()
+        store : CaseStore
+            the stored results of each case, see markRecord()
+        '''
+        self.script_filepath = script_filepath
+        self.concurrency = concurrency or mp.cpu_count()
+        self.max_pending = self.concurrency * 4 if max_pending is None else max_pending
+        self.cache = cache
+        self.store = store
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.running = 0
+        self.waiting = 0
+
+
+    async def mark(self, code):
+        '''
+        Mark a submission once one of the slots is free.
+
+        Returns
+        -------
+        list:
+            the report returned by the marking script
+        '''
+        if self.semaphore.locked() and self.waiting >= self.max_pending:
+            raise MarkerBusy('{} submissions are waiting'.format(self.waiting))
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            return await markAsync(code, self.script_filepath, self.cache, self.executor,
+                                   self.store)
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+LEVEL_NAMES = {
+    SUCCESS: 'OK',
+    WARNING: 'WARNING',
+    ERROR  : 'ERROR'
+}
+
+def formatReport(report):
+    '''
+    Format a report as text.
+
+    Parameters
+    ----------
+    report : list
+        the report returned by Assignment.generateReport()
+
+    Returns
+    -------
+    str:
+        one line for each message of the report
+    '''
+    lines = []
+    for line in report:
+        if isinstance(line, dict):
+            lines.append('[{}] {}'.format(LEVEL_NAMES.get(line['err'], line['err']), line['msg']))
+        else:
+            lines.append(str(line))
+
+    return '\n'.join(lines) + '\n'
+
+
+############################################
+# Bulk marking
+############################################
+
+
+# messages sent by bulk marking workers
+STARTED  = 0
+FINISHED = 1
+RETIRED  = 2
+DONE     = 3
+TAKEN    = 4
+
+
+class ResultPipe(object):
+    '''
+    Carries the messages of the bulk marking workers to the marking process.
+    Unlike a multiprocessing.Queue, a message is written to the pipe before
+    put() returns, so the messages of a worker which crashes right after
+    sending them are not lost.
+    '''
+
+    def __init__(self):
+        self.reader, self.writer = mp.Pipe(duplex = False)
+        self.lock = mp.Lock()
+
+
+    def put(self, message):
+        with self.lock:
+            self.writer.send(message)
+
+
+    def get(self, timeout = None):
+        '''
+        Receive the next message, raises queue.Empty after timeout seconds.
+        '''
+        if not self.reader.poll(timeout):
+            raise queue.Empty()
+
+        return self.reader.recv()
+
+
+    def get_nowait(self):
+        return self.get(0)
+
+
+def _markFile(filepath, script_filepath, suffix, cache):
+    with open(filepath) as fin:
+        code = fin.read()
+
+    try:
+        record = markRecord(code, script_filepath, cache)
+        report = formatReport(record['report'])
+        error = None
+    except (Exception, SystemExit) as err:
+        error = str(err) or type(err).__name__
+        record = None
+        report = _failedReport(error)
+
+    _writeReport(filepath, suffix, report)
+    return error, record
+
+
+def _failedReport(error):
+    return 'Marking failed: {}\n'.format(error)
+
+
+def _writeReport(filepath, suffix, report):
+    with open(filepath + suffix, 'w') as fout:
+        fout.write(report)
+
+
+def _bulkWorker(worker_id, script_filepath, suffix, cache, store, records, max_tasks, tasks,
+                results):
+    loadScript(script_filepath)
+
+    marked = 0
+    while marked < max_tasks:
+        group = tasks.get()
+        if group is None:
+            results.put((DONE, worker_id, None, None, None))
+            return
+
+        results.put((TAKEN, worker_id, None, None, group))
+
+        # files of a group have the same fingerprint and share runtime results,
+        # which the case store keeps by fingerprint already
+        if store is None and len(group) > 1:
+            memo = RuntimeMemo()
+        else:
+            memo = store
+
+        with runtimeMemo(memo):
+            for filepath in group:
+                results.put((STARTED, worker_id, filepath, None, None))
+                try:
+                    error, record = _markFile(filepath, script_filepath, suffix, cache)
+                except (Exception, SystemExit) as err:
+                    error, record = str(err) or type(err).__name__, None
+                results.put((FINISHED, worker_id, filepath, error, record if records else None))
+
+        marked += len(group)
+
+    results.put((RETIRED, worker_id, None, None, None))
+
+
+def markFolder(folder, script_filepath, pattern = '*.py', suffix = '.report.txt',
+               processes = None, max_tasks = 500, callback = None, cache = None,
+               dedup = False, sink = None, store = None, file_timeout = 300):
+    '''
+    Mark all the files inside a folder and write the report of each file
+    next to it. The marking script is loaded once by each marking process
+    and the files are spread over a pool of processes.
+
+    Parameters
+    ----------
+    folder : str
+        the folder of submissions
+    script_filepath : str
+        path of the marking script, see mark()
+    pattern : str
+        glob pattern of the submissions inside the folder
+    suffix : str
+        the report of file f is written to f + suffix
+    processes : int
+        the number of marking processes, the number of cores by default
+    max_tasks : int
+        the number of files marked by a process before it is replaced
+        by a fresh one, which keeps memory usage and throughput stable
+    callback : function
+        called with (filepath, error) after each file, error is None
+        if the file was marked
+    cache : ResultCache
+        the cache of results shared by the marking processes, see markRecord()
+    dedup : bool
+        if it is true, files are first grouped by the fingerprint of their
+        normalized syntax tree and each group is marked by one process.
+        Test cases and unittests run once per group and their results are
+        shared by its files, while compilation and style checks still run
+        for every file
+    sink : JsonLinesSink
+        if it is given, the record of each file is written to it as soon
+        as the file is marked, with the file path and the error, see
+        markRecord(). The sink is not closed
+    store : CaseStore
+        the stored results of each case shared by the marking processes,
+        see markRecord()
+    file_timeout : float
+        the maximum number of seconds spent marking one file, None means
+        no limit. The marking process of a file which takes longer, such
+        as a submission whose module body never ends, is killed and the
+        file fails like a file whose marking process crashed
+
+    Returns
+    -------
+    dict:
+        total, marked and failed number of files, elapsed seconds
+        and rate in files per second
+    '''
+    started_at = time.time()
+    script_path = os.path.abspath(script_filepath)
+    filepaths = sorted(
+        f for f in glob.glob(os.path.join(folder, pattern))
+        if os.path.isfile(f) and os.path.abspath(f) != script_path)
+
+    if dedup:
+        groups = groupByFingerprint(filepaths)
+    else:
+        groups = [[filepath] for filepath in filepaths]
+
+    processes = max(1, min(processes or mp.cpu_count(), len(groups)))
+
+    # load the script once before the workers are forked
+    loadScript(script_filepath)
+
+    tasks = mp.Queue()
+    results = ResultPipe()
+    for group in groups:
+        tasks.put(group)
+    for _ in range(processes):
+        tasks.put(None)
+
+    def spawn(worker_id):
+        worker = mp.Process(target = _bulkWorker,
+            args = (worker_id, script_filepath, suffix, cache, store, sink is not None,
+                    max_tasks, tasks, results))
+        worker.start()
+        return worker
+
+    workers = {i: spawn(i) for i in range(processes)}
+    current = {}
+    # the time each worker started marking its current file
+    started = {}
+    # the files of the group taken by each worker which are not finished
+    taken = {}
+    counts = {'finished': 0, 'failed': 0, 'next_id': processes}
+
+    def finish(filepath, error, record = None):
+        counts['finished'] += 1
+        if error is not None:
+            counts['failed'] += 1
+        if sink is not None:
+            entry = {'file': filepath, 'error': error}
+            entry.update(record or {})
+            sink.write(entry)
+        if callback:
+            callback(filepath, error)
+
+    def add():
+        workers[counts['next_id']] = spawn(counts['next_id'])
+        counts['next_id'] += 1
+
+    def replace(worker_id):
+        workers.pop(worker_id).join()
+        taken.pop(worker_id, None)
+        add()
+
+    def requeue(group):
+        # the group comes after the end markers of the other workers,
+        # so it gets a new worker and its own end marker
+        tasks.put(group)
+        tasks.put(None)
+        add()
+
+    def handle(kind, worker_id, filepath, error, record):
+        if kind == TAKEN:
+            taken[worker_id] = list(record)
+        elif kind == STARTED:
+            current[worker_id] = filepath
+            started[worker_id] = time.time()
+        elif kind == FINISHED:
+            current.pop(worker_id, None)
+            started.pop(worker_id, None)
+            if filepath in taken.get(worker_id, []):
+                taken[worker_id].remove(filepath)
+            finish(filepath, error, record)
+        elif kind == RETIRED:
+            replace(worker_id)
+        elif kind == DONE:
+            workers.pop(worker_id).join()
+            taken.pop(worker_id, None)
+
+    try:
+        while workers:
+            try:
+                handle(*results.get(timeout = 0.5))
+            except queue.Empty:
+                pass
+
+            # replace the workers crashed by a submission, or stuck on a file
+            now = time.time()
+            for worker_id, worker in list(workers.items()):
+                if worker_id not in workers:
+                    continue
+
+                overdue = file_timeout is not None and \
+                          now - started.get(worker_id, now) > file_timeout
+                if worker.is_alive() and not overdue:
+                    continue
+
+                if overdue:
+                    worker.kill()
+                    worker.join()
+
+                # a dead worker may still have messages in the queue
+                try:
+                    while True:
+                        handle(*results.get_nowait())
+                except queue.Empty:
+                    pass
+
+                if worker_id in workers:
+                    # the file being marked fails, and the rest of its group
+                    # is marked again by a fresh worker
+                    rest = taken.pop(worker_id, [])
+                    if worker_id in current:
+                        crashed = current.pop(worker_id)
+                        started.pop(worker_id, None)
+                        rest = [filepath for filepath in rest if filepath != crashed]
+                        if overdue:
+                            error = 'marking timed out after {} seconds'.format(file_timeout)
+                        else:
+                            error = 'marking process crashed'
+                        _writeReport(crashed, suffix, _failedReport(error))
+                        finish(crashed, error)
+                    replace(worker_id)
+                    if rest:
+                        requeue(rest)
+    except BaseException:
+        # a failing callback or sink would leave the workers blocked on the queue
+        for worker in workers.values():
+            worker.terminate()
+        raise
 
-        # mark code
-        return mark_script(base_dir, code)
\ No newline at end of file
+    elapsed = time.time() - started_at
+    return {
+        'total'  : len(filepaths),
+        'marked' : counts['finished'] - counts['failed'],
+        'failed' : counts['failed'],
+        'elapsed': elapsed,
+        'rate'   : counts['finished'] / elapsed if elapsed > 0 else 0.0
+    }
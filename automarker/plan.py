@@ -0,0 +1,304 @@
+'''
+Declarative marking plans.
+
+A plan describes the compilation rules, the test cases of functions and the
+unittests of a marking script once, as a dict or a JSON file:
+
+    {
+        "compilation": [
+            {"rule": "FollowFormattingStyle", "description": "Checking Format"},
+            {"rule": "NotUseImports", "args": [["doctest"]],
+             "description": "Do not import any modules"}
+        ],
+        "functions": [
+            {"name": "extract_mentions", "max_timeouts": 2, "cases": [
+                {"when": [""], "returnType": "list"},
+                {"when": ["@a"], "return": ["a"]}
+            ]},
+            {"name": "count_words", "cases": [
+                {"when": ["aaa", {}], "notReturn": true},
+                {"when": ["aaa", {}], "modifyParams": ["aaa", {"aaa": 1}]}
+            ]}
+        ],
+        "unittests": [{"path": "tweets_tests.py", "max_running_time": 2}]
+    }
+
+compilePlan() validates the description and compiles it into an immutable
+MarkingPlan, whose rules are created and whose test cases are pickled once.
+Applying the plan to a submission then only runs the checkers.
+'''
+
+import builtins
+import copy
+import json
+import os
+from collections import namedtuple
+
+from . import compilation
+from .functions import FunctionChecker, UnittestChecker, \
+    modifiesParams, returns, returnsNothing, returnsType
+from .marker import Assignment
+from .sandbox import pickleCase
+
+# compilation rules available to plans, by name
+RULES = {
+    'FollowFormattingStyle': compilation.FollowFormattingStyle,
+    'HaveDocstrings'       : compilation.HaveDocstrings,
+    'NotUseEval'           : compilation.NotUseEval,
+    'NotUseFuncs'          : compilation.NotUseFuncs,
+    'NotUseImports'        : compilation.NotUseImports,
+    'NotUseInput'          : compilation.NotUseInput,
+    'NotUsePrint'          : compilation.NotUsePrint
+}
+
+# keys of the expectations of a case, see FunctionTestCase
+EXPECTATIONS = {
+    'returnType'  : returnsType,
+    'return'      : returns,
+    'notReturn'   : returnsNothing,
+    'modifyParams': modifiesParams
+}
+
+PLAN_KEYS      = {'compilation', 'functions', 'unittests'}
+RULE_KEYS      = {'rule', 'args', 'description'}
+FUNCTION_KEYS  = {'name', 'cases', 'max_timeouts', 'max_running_time', 'deferred', 'profile'}
+CASE_KEYS      = {'when', 'description', 'max_running_time'} | set(EXPECTATIONS)
+UNITTEST_KEYS  = {'path', 'module_name', 'max_running_time', 'processes', 'profile'}
+
+PlannedRule = namedtuple('PlannedRule', ['rule', 'description'])
+PlannedFunction = namedtuple('PlannedFunction',
+                             ['name', 'cases', 'max_timeouts', 'deferred', 'profile'])
+PlannedCase = namedtuple('PlannedCase',
+                         ['description', 'args', 'expectation', 'expected',
+                          'max_running_time', 'payload'])
+PlannedUnittest = namedtuple('PlannedUnittest',
+                             ['path', 'module_name', 'max_running_time', 'processes',
+                              'profile'])
+
+
+class PlanError(ValueError):
+    '''
+    Raised when a marking plan is not valid.
+    '''
+
+
+class MarkingPlan(object):
+    '''
+    An immutable marking plan, see compilePlan(). It is pickled as its
+    description, so it can be sent to other processes.
+    '''
+
+    def __init__(self, spec, base_dir, rules, functions, unittests):
+        for name, value in [('spec', spec), ('base_dir', base_dir), ('rules', rules),
+                            ('functions', functions), ('unittests', unittests)]:
+            object.__setattr__(self, name, value)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('a MarkingPlan is immutable')
+
+
+    def __reduce__(self):
+        return compilePlan, (self.spec, self.base_dir)
+
+
+    def apply(self, assignment, pool = None, calibration = None):
+        '''
+        Check an assignment with this plan. The test cases and the
+        unittests only run if the assignment compiles.
+
+        Parameters
+        ----------
+        assignment : Assignment
+            the assignment to be checked
+        pool : SandboxPool
+            the sandbox workers running the test cases, see FunctionChecker
+        calibration : Calibration
+            the calibration of the deadlines, see FunctionChecker
+
+        Returns
+        -------
+        bool:
+            whether the assignment compiled
+        '''
+        checker = compilation.CompilationChecker(assignment)
+        for rule, description in self.rules:
+            checker.should(rule, description)
+        compiled = checker.check()
+
+        if not compiled:
+            return False
+
+        for function in self.functions:
+            checker = FunctionChecker(assignment, function.name, pool = pool,
+                                      deferred = function.deferred, calibration = calibration,
+                                      max_timeouts = function.max_timeouts,
+                                      profile = function.profile)
+            for planned in function.cases:
+                case = checker.newCase(planned.description)
+                case.max_running_time = planned.max_running_time
+                case.payload = planned.payload
+                case.when(*planned.args).expect(planned.expectation, planned.expected)
+
+            if function.deferred:
+                checker.check()
+
+        for unittest in self.unittests:
+            UnittestChecker(assignment, unittest.path, module_name = unittest.module_name,
+                            max_running_time = unittest.max_running_time,
+                            calibration = calibration, processes = unittest.processes,
+                            profile = unittest.profile).check()
+
+        return True
+
+
+    def mark(self, base_dir, code):
+        '''
+        Mark a submission with this plan, like the mark() of a marking
+        script, so a script can be as short as:
+
+            plan = loadPlan('plan.json')
+            mark = plan.mark
+
+        Returns
+        -------
+        list:
+            the report of the submission
+        '''
+        assignment = Assignment(code)
+        self.apply(assignment)
+        return assignment.generateReport()
+
+
+def _checkKeys(where, spec, allowed, required = ()):
+    if not isinstance(spec, dict):
+        raise PlanError('{}: expected an object, got {}'.format(where, type(spec).__name__))
+
+    unknown = set(spec) - allowed
+    if unknown:
+        raise PlanError('{}: unknown keys {}'.format(where, ', '.join(sorted(unknown))))
+
+    for key in required:
+        if key not in spec:
+            raise PlanError('{}: missing key {}'.format(where, key))
+
+
+def _checkList(where, value):
+    if not isinstance(value, list):
+        raise PlanError('{}: expected a list, got {}'.format(where, type(value).__name__))
+    return value
+
+
+def _compileRule(where, spec):
+    _checkKeys(where, spec, RULE_KEYS, ('rule', 'description'))
+    if spec['rule'] not in RULES:
+        raise PlanError('{}: unknown rule {!r}'.format(where, spec['rule']))
+
+    try:
+        rule = RULES[spec['rule']](*_checkList(where + '.args', spec.get('args', [])))
+    except TypeError as err:
+        raise PlanError('{}: {}'.format(where, err))
+
+    return PlannedRule(rule, spec['description'])
+
+
+def _compileCase(where, spec, max_running_time):
+    _checkKeys(where, spec, CASE_KEYS)
+    keys = [key for key in EXPECTATIONS if key in spec]
+    if len(keys) != 1:
+        raise PlanError('{}: expected one of {}'.format(where, ', '.join(EXPECTATIONS)))
+
+    expectation = EXPECTATIONS[keys[0]]
+    expected = spec[keys[0]]
+    if expectation is returnsType and isinstance(expected, str):
+        expected = getattr(builtins, expected, None)
+    if expectation is returnsType and not isinstance(expected, type):
+        raise PlanError('{}: unknown type {!r}'.format(where, spec[keys[0]]))
+    if expectation is returnsNothing:
+        expected = None
+    if expectation is modifiesParams:
+        expected = tuple(_checkList(where + '.modifyParams', expected))
+
+    args = tuple(_checkList(where + '.when', spec.get('when', [])))
+    try:
+        payload = pickleCase(args, expectation, expected)
+    except Exception as err:
+        raise PlanError('{}: cannot be pickled: {}'.format(where, err))
+
+    return PlannedCase(spec.get('description', ''), args,
+                       expectation, expected, spec.get('max_running_time', max_running_time),
+                       payload)
+
+
+def _compileFunction(where, spec):
+    _checkKeys(where, spec, FUNCTION_KEYS, ('name', 'cases'))
+    if not isinstance(spec['name'], str) or not spec['name'].isidentifier():
+        raise PlanError('{}: invalid function name {!r}'.format(where, spec['name']))
+
+    cases = tuple(
+        _compileCase('{}.cases[{}]'.format(where, i), case, spec.get('max_running_time', 1))
+        for i, case in enumerate(_checkList(where + '.cases', spec['cases'])))
+    return PlannedFunction(spec['name'], cases, spec.get('max_timeouts'),
+                           spec.get('deferred', True), spec.get('profile', False))
+
+
+def _compileUnittest(where, spec, base_dir):
+    _checkKeys(where, spec, UNITTEST_KEYS, ('path',))
+    path = os.path.join(base_dir, spec['path'])
+    if not os.path.isfile(path):
+        raise PlanError('{}: no unittest file {}'.format(where, path))
+
+    return PlannedUnittest(path, spec.get('module_name'), spec.get('max_running_time', 2),
+                           spec.get('processes'), spec.get('profile', False))
+
+
+def compilePlan(spec, base_dir = '.'):
+    '''
+    Validate the description of a marking plan and compile it.
+
+    Parameters
+    ----------
+    spec : dict
+        the description of the plan, see the documentation of this module.
+        Types of returnType are builtin type names, or types
+    base_dir : str
+        the directory of the relative unittest paths
+
+    Returns
+    -------
+    MarkingPlan:
+        the compiled plan
+
+    Raises
+    ------
+    PlanError:
+        if the description is not valid
+    '''
+    _checkKeys('plan', spec, PLAN_KEYS)
+    spec = copy.deepcopy(spec)
+
+    rules = tuple(
+        _compileRule('compilation[{}]'.format(i), rule)
+        for i, rule in enumerate(_checkList('compilation', spec.get('compilation', []))))
+    functions = tuple(
+        _compileFunction('functions[{}]'.format(i), function)
+        for i, function in enumerate(_checkList('functions', spec.get('functions', []))))
+    unittests = tuple(
+        _compileUnittest('unittests[{}]'.format(i), unittest, base_dir)
+        for i, unittest in enumerate(_checkList('unittests', spec.get('unittests', []))))
+
+    return MarkingPlan(spec, base_dir, rules, functions, unittests)
+
+
+def loadPlan(plan_filepath):
+    '''
+    Load and compile a marking plan from a JSON file, see compilePlan().
+    Relative unittest paths are relative to the directory of the file.
+    '''
+    with open(plan_filepath) as fin:
+        try:
+            spec = json.load(fin)
+        except ValueError as err:
+            raise PlanError('{}: {}'.format(plan_filepath, err))
+
+    return compilePlan(spec, os.path.dirname(os.path.abspath(plan_filepath)))
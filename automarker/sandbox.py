@@ -0,0 +1,1328 @@
+import asyncio
+import atexit
+import cProfile
+import ctypes
+import errno
+import hashlib
+import imp
+import importlib
+import io
+import json
+import marshal
+import math
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+import os
+import pickle
+import pstats
+import re
+import resource
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .events import FailedReturn
+
+
+# the number of loaded assignment codes kept by each worker
+MAX_CACHED_MODULES = 8
+
+# message kinds
+CALL  = 0
+BATCH = 1
+TASK  = 2
+
+# the interval in seconds at which a zygote reaps the workers which exited
+REAP_INTERVAL = 0.5
+
+# prctl() option killing a process when its parent dies
+PR_SET_PDEATHSIG = 1
+
+
+class SandboxError(Exception):
+    '''
+    Raised when a sandbox worker cannot deliver the result of a case.
+    '''
+
+
+class SandboxTimeout(SandboxError):
+    '''
+    Raised when a case does not finish before its deadline.
+    '''
+
+
+class SandboxCrashed(SandboxError):
+    '''
+    Raised when a sandbox worker dies while running a case.
+    '''
+
+
+class CpuLimitExceeded(BaseException):
+    '''
+    Raised inside a sandbox when a case uses up its CPU time. It isn't an
+    Exception, so a submission catching Exception doesn't swallow it.
+    '''
+
+
+# resources limited by SandboxLimits
+MEMORY    = 'memory'
+CPU_TIME  = 'CPU time'
+PROCESSES = 'processes'
+FILE_SIZE = 'file size'
+OUTPUT    = 'output'
+
+# the bytes kept from the beginning, and from the end, of the output of a case
+OUTPUT_EXCERPT = 500
+
+# the number of hotspots kept from the profile of a case
+PROFILE_TOP = 5
+
+# profiled builtin functions and methods, see profileHotspots()
+BUILTIN_FILENAME = '~'
+BUILTIN_METHOD_RE = re.compile(r"^<method '(\w+)' of '([\w.]+)' objects>$")
+BUILTIN_FUNCTION_RE = re.compile(r'^<built-in method (?:builtins\.)?([\w.]+)>$')
+
+
+class OutputLimitExceeded(BaseException):
+    '''
+    Raised inside a sandbox when a case writes more output than its budget,
+    see SandboxLimits. Like CpuLimitExceeded, it isn't an Exception.
+    '''
+
+
+class OutputCapture(io.TextIOBase):
+    '''
+    Replaces sys.stdout and sys.stderr inside a sandbox. The output of each
+    case is counted, and only its beginning and, in a ring buffer, its end
+    are kept, so a case printing in a loop uses a fixed amount of memory
+    and never floods the terminal of the marking process.
+    '''
+
+    def __init__(self, budget = None, excerpt = OUTPUT_EXCERPT):
+        '''
+        Parameters
+        ----------
+        budget : int
+            the number of bytes a case may write before OutputLimitExceeded
+            is raised, None means no limit
+        excerpt : int
+            the number of bytes kept from the beginning, and from the end,
+            of the output of a case
+        '''
+        self.budget = budget
+        self.excerpt = excerpt
+        self.ring = bytearray(excerpt)
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Forget the output of the previous case.
+        '''
+        self.total = 0
+        self.head = bytearray()
+        self.end = 0
+        self.filled = 0
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, text):
+        data = str(text).encode('utf-8', 'replace')
+        self.total += len(data)
+
+        if len(self.head) < self.excerpt:
+            taken = data[:self.excerpt - len(self.head)]
+            self.head += taken
+            data = data[len(taken):]
+
+        size = len(self.ring)
+        if len(data) >= size:
+            self.ring[:] = data[-size:]
+            self.end = 0
+            self.filled = size
+        elif data:
+            first = min(len(data), size - self.end)
+            self.ring[self.end:self.end + first] = data[:first]
+            self.ring[:len(data) - first] = data[first:]
+            self.end = (self.end + len(data)) % size
+            self.filled = min(size, self.filled + len(data))
+
+        if self.budget is not None and self.total > self.budget:
+            raise OutputLimitExceeded()
+
+        return len(text)
+
+
+    def summary(self):
+        '''
+        Summarize the output of the current case.
+
+        Returns
+        -------
+        tuple:
+            (number of bytes written, excerpt of the beginning and the end),
+            or None if the case wrote nothing
+        '''
+        if not self.total:
+            return None
+
+        if self.filled == len(self.ring):
+            tail = self.ring[self.end:] + self.ring[:self.end]
+        else:
+            tail = self.ring[:self.filled]
+
+        skipped = self.total - len(self.head) - len(tail)
+        excerpt = bytes(self.head) + (b' ... ' if skipped else b'') + bytes(tail)
+        return self.total, excerpt.decode('utf-8', 'replace')
+
+
+def _raiseCpuLimitExceeded(signum, frame):
+    raise CpuLimitExceeded()
+
+
+def _setLimit(limit, value):
+    if value is not None:
+        _, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, value))
+
+
+class SandboxLimits(object):
+    '''
+    POSIX resource limits applied to sandbox workers.
+    '''
+
+    def __init__(self, memory = None, cpu_time = None, processes = None, file_size = None,
+                 output = None):
+        '''
+        Create new sandbox limits, None means no limit.
+
+        Parameters
+        ----------
+        memory : int
+            the maximum address space of a worker in bytes (RLIMIT_AS)
+        cpu_time : int
+            the maximum CPU seconds of each case (RLIMIT_CPU). The limit
+            has a granularity of one second: the CPU time already used by
+            the process is rounded up, so a case gets at least cpu_time and
+            less than cpu_time + 1 seconds
+        processes : int
+            the maximum number of processes of the user running the
+            worker (RLIMIT_NPROC), 0 forbids forking. It has no effect
+            when marking as root.
+        file_size : int
+            the maximum size in bytes of a file written by a worker (RLIMIT_FSIZE)
+        output : int
+            the maximum number of bytes written to stdout and stderr by each
+            case, the case is stopped when it writes more. The output is
+            captured whether it is limited or not, see OutputCapture
+        '''
+        self.memory = memory
+        self.cpu_time = cpu_time
+        self.processes = processes
+        self.file_size = file_size
+        self.output = output
+        self.capture = None
+
+
+    def apply(self):
+        '''
+        Apply the limits to the current process, called once in each worker.
+        The limit of processes is applied by confine(), since workers fork
+        a child for each case.
+        '''
+        for limit, value in ((resource.RLIMIT_AS, self.memory),
+                             (resource.RLIMIT_FSIZE, self.file_size)):
+            _setLimit(limit, value)
+
+        if self.file_size is not None:
+            # writing too much raises OSError(EFBIG) instead of killing the worker
+            signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+
+        if self.cpu_time is not None:
+            signal.signal(signal.SIGXCPU, _raiseCpuLimitExceeded)
+
+        self.capture = OutputCapture(self.output)
+        sys.stdout = sys.stderr = self.capture
+
+
+    def confine(self):
+        '''
+        Apply the limit of processes to the process running a case.
+        '''
+        _setLimit(resource.RLIMIT_NPROC, self.processes)
+
+
+    def startCase(self):
+        '''
+        Give the next case its own CPU time. The soft limit is moved past
+        the CPU time already used by this process, rounded up to the next
+        second, and the output of the previous case is forgotten.
+        '''
+        if self.capture is not None:
+            self.capture.reset()
+
+        if self.cpu_time is None:
+            return
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = math.ceil(usage.ru_utime + usage.ru_stime) + self.cpu_time
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+    def caseOutput(self):
+        '''
+        The (bytes written, excerpt) of the current case, or None, see
+        OutputCapture.summary().
+        '''
+        return self.capture.summary() if self.capture is not None else None
+
+
+    def exceeded(self, err):
+        '''
+        Get the resource whose limit caused an error, or None.
+
+        Parameters
+        ----------
+        err : BaseException
+            the error raised by a case
+
+        Returns
+        -------
+        str:
+            MEMORY, CPU_TIME, PROCESSES, FILE_SIZE, OUTPUT or None
+        '''
+        if isinstance(err, CpuLimitExceeded):
+            return CPU_TIME
+        elif isinstance(err, OutputLimitExceeded):
+            return OUTPUT
+        elif isinstance(err, MemoryError) and self.memory is not None:
+            return MEMORY
+        elif isinstance(err, OSError):
+            if err.errno == errno.EFBIG and self.file_size is not None:
+                return FILE_SIZE
+            elif err.errno == errno.EAGAIN and self.processes is not None:
+                return PROCESSES
+
+        return None
+
+
+def sourceKey(source_code, dependencies = []):
+    '''
+    Compute the key used by workers to cache a loaded assignment module.
+
+    Parameters
+    ----------
+    source_code : string
+        source code of the assignment
+    dependencies : list of modules
+        assignment dependency modules
+
+    Returns
+    -------
+    str:
+        the cache key
+    '''
+    h = hashlib.sha1(source_code.encode('utf-8'))
+    for dependency in dependencies:
+        h.update(b'\0' + dependency.__name__.encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def _loadCode(code, dependencies):
+    '''
+    Unmarshal the code of an assignment and import its dependencies, once
+    for all the cases of the assignment run by a worker.
+    '''
+    modules = []
+    for name in dependencies:
+        if name in sys.modules:
+            modules.append(sys.modules[name])
+        else:
+            modules.append(importlib.import_module(name))
+
+    return marshal.loads(code), modules
+
+
+def _newModule(loaded):
+    '''
+    Execute the body of an assignment in a fresh module, so that a case
+    never sees the globals changed by the cases run before it.
+    '''
+    code, dependencies = loaded
+    module = imp.new_module('assignment')
+    for dependency in dependencies:
+        module.__dict__[dependency.__name__] = dependency
+
+    exec(code, module.__dict__)
+    return module
+
+
+def caseTiming(total, wall = 0.0, cpu = 0.0, spawn = 0.0, compare = 0.0, timeout = False,
+               output = None, profile = None):
+    '''
+    Build the timing record of a test case, all times are in seconds.
+
+    Parameters
+    ----------
+    total : float
+        time spent by the marking process on this case
+    wall : float
+        wall time of the function call inside the sandbox
+    cpu : float
+        CPU time of the function call inside the sandbox
+    spawn : float
+        time spent starting a sandbox worker for this case
+    compare : float
+        time spent checking the result against the expectation
+    timeout : bool
+        whether the case timed out
+    output : tuple
+        (bytes written, excerpt) of the output of the case, or None,
+        see OutputCapture.summary()
+    profile : list
+        the hotspots of a profiled case, see profileHotspots()
+
+    Returns
+    -------
+    dict:
+        the timing record, whose ipc is the rest of the total time, with
+        the number of bytes of output, its excerpt and the hotspots
+    '''
+    if timeout:
+        # the case ran until it was stopped
+        wall = max(0.0, total - spawn)
+
+    return {
+        'total'  : total,
+        'wall'   : wall,
+        'cpu'    : cpu,
+        'spawn'  : spawn,
+        'ipc'    : max(0.0, total - wall - spawn - compare),
+        'compare': compare,
+        'timeout': timeout,
+        'output' : output[0] if output else 0,
+        'excerpt': output[1] if output else None,
+        'profile': profile
+    }
+
+
+def _builtinName(name):
+    match = BUILTIN_METHOD_RE.match(name)
+    if match:
+        return '{}.{}()'.format(match.group(2), match.group(1))
+
+    match = BUILTIN_FUNCTION_RE.match(name)
+    if match:
+        return match.group(1) + '()'
+
+    return name
+
+
+def profileHotspots(profiler, filename, top = PROFILE_TOP):
+    '''
+    Summarize the profile of a case to the code of the submission: the
+    functions compiled from filename, and the builtin functions and methods
+    they call, such as list.count() in a loop, which are counted apart for
+    each calling function.
+
+    Parameters
+    ----------
+    profiler : cProfile.Profile
+        the profiler which ran the case
+    filename : str
+        the file name of the compiled submission
+    top : int
+        the number of hotspots kept
+
+    Returns
+    -------
+    list of tuple:
+        (name, line, calls, own seconds, cumulative seconds) of the hotspots
+        taking the most time by themselves, the line is where the function,
+        or the function calling a builtin, is defined
+    '''
+    spots = []
+    for (path, line, name), (_, calls, own, cumulative, callers) in \
+            pstats.Stats(profiler).stats.items():
+        if path == filename:
+            spots.append((name + '()', line, calls, own, cumulative))
+        elif path == BUILTIN_FILENAME:
+            for (caller_path, caller_line, caller_name), (_, calls, own, cumulative) in \
+                    callers.items():
+                if caller_path == filename:
+                    spots.append(('{} in {}()'.format(_builtinName(name), caller_name),
+                                  caller_line, calls, own, cumulative))
+
+    spots.sort(key = lambda spot: -spot[3])
+    return spots[:top]
+
+
+def _call(loaded, func_name, args, limits, profile = False):
+    wall = cpu = 0.0
+    # the profiler is only created for profiled cases, see profileHotspots()
+    profiler = cProfile.Profile() if profile else None
+    filename = None
+    try:
+        limits.confine()
+        limits.startCase()
+        func = getattr(_newModule(loaded), func_name)
+        filename = getattr(getattr(func, '__code__', None), 'co_filename', None)
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+        try:
+            if profiler is None:
+                r = func(*args)
+            else:
+                r = profiler.runcall(func, *args)
+        finally:
+            wall = time.perf_counter() - wall_started
+            cpu = time.process_time() - cpu_started
+
+        return True, args, r, (wall, cpu, limits.caseOutput(),
+                               _hotspots(profiler, filename)), None
+    except (Exception, CpuLimitExceeded, OutputLimitExceeded) as err:
+        return False, args, None, (wall, cpu, limits.caseOutput(),
+                                   _hotspots(profiler, filename)), limits.exceeded(err)
+
+
+def _hotspots(profiler, filename):
+    if profiler is None or filename is None:
+        return None
+
+    return profileHotspots(profiler, filename)
+
+
+def _send(conn, reply, fallback):
+    try:
+        conn.send(reply)
+    except Exception:
+        # the return value or the modified parameters cannot be pickled
+        conn.send(fallback)
+
+
+def _dieWithParent(parent):
+    # a case left running by a worker killed at its deadline is killed too
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except Exception:
+        pass
+
+    if os.getppid() != parent:
+        os._exit(1)
+
+
+def _isolatedCall(modules, key, code, dependencies, func_name, args, limits, profile):
+    '''
+    Run a case in a throwaway child of the worker, like the cases of the
+    same and of other submissions, so that whatever the submission changes,
+    such as builtins, imported modules, the random state or the current
+    directory, is forgotten with the child. The worker itself never runs
+    the code of a submission, and checks the expectations of the cases.
+    Only the assignment code and its dependencies are loaded by the worker,
+    once for all the cases of an assignment.
+
+    Returns
+    -------
+    tuple:
+        (success, modified parameters, return value, times, limit), see
+        _call(). A child which dies without replying is a failed case, and
+        values which cannot be pickled are replaced by None
+    '''
+    crashed = (False, args, None, (0.0, 0.0, None, None), None)
+    try:
+        if key not in modules:
+            if len(modules) >= MAX_CACHED_MODULES:
+                del modules[next(iter(modules))]
+            modules[key] = _loadCode(code, dependencies)
+    except Exception:
+        return crashed
+
+    loaded = modules[key]
+    reader, writer = mp.Pipe(duplex = False)
+    parent = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            reader.close()
+            _dieWithParent(parent)
+            reply = _call(loaded, func_name, args, limits, profile)
+            _send(writer, reply, (False, (), None, reply[3], reply[4]))
+        finally:
+            os._exit(0)
+
+    writer.close()
+    try:
+        return reader.recv()
+    except EOFError:
+        return crashed
+    finally:
+        reader.close()
+        os.waitpid(pid, 0)
+
+
+def _workerMain(conn, limits):
+    limits.apply()
+    modules = {}
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+
+        kind, key, code, dependencies, func_name, payload, profile = message
+
+        if kind == CALL:
+            reply = _isolatedCall(modules, key, code, dependencies, func_name, payload, limits,
+                                  profile)
+            _send(conn, reply, (False, (), None, reply[3], reply[4]))
+
+        elif kind == BATCH:
+            for case in payload:
+                # each case is unpickled on its own, so cases passing the same
+                # objects get fresh copies, see pickleCase()
+                args, expectation, expected = pickle.loads(case)
+                args = pickle.loads(args)
+                success, post_args, r, (wall, cpu, output, hotspots), limit = _isolatedCall(
+                    modules, key, code, dependencies, func_name, args, limits, profile)
+
+                compare_started = time.perf_counter()
+                try:
+                    passed = bool(expectation(expected, success, post_args, r))
+                except Exception:
+                    passed = False
+                timing = (wall, cpu, time.perf_counter() - compare_started, output, hotspots)
+
+                if passed:
+                    conn.send((True, None, timing, None))
+                else:
+                    # only the type and the truncated repr of the return value are sent
+                    conn.send((False, FailedReturn(r), timing, limit))
+
+        elif kind == TASK:
+            # a task has the worker to itself, see forkTask()
+            func, args = payload
+            func(conn, limits, _loadCode(code, dependencies), *args)
+            return
+
+
+async def waitReadable(conn, timeout):
+    '''
+    Wait until a connection has data to receive, or is closed, without
+    blocking the event loop.
+
+    Parameters
+    ----------
+    conn : multiprocessing.connection.Connection
+        the connection
+    timeout : float
+        the maximum waiting time in seconds
+
+    Returns
+    -------
+    bool:
+        False if the waiting timed out
+    '''
+    if conn.poll():
+        return True
+
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    fd = conn.fileno()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(True))
+    try:
+        return await asyncio.wait_for(ready, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(fd)
+
+
+def _batchMessage(assignment, func_name, cases, profile):
+    return (BATCH, assignment.key, assignment.marshaled_code,
+            [d.__name__ for d in assignment.dependencies], func_name,
+            [case[4] if len(case) > 4 else pickleCase(*case[:3]) for case in cases], profile)
+
+
+def pickleCase(args, expectation, expected):
+    '''
+    Pickle the parameters, the expectation and the expected value of a test
+    case, as it is sent in a batch. Each case is pickled on its own, so a
+    case never shares an object with another case of the batch, and its
+    parameters are pickled apart from its expected value, which they cannot
+    modify. A case pickled beforehand, for the batches of many submissions,
+    is the optional fifth item of a case, see runBatch().
+    '''
+    args = pickle.dumps(args, protocol = pickle.HIGHEST_PROTOCOL)
+    return pickle.dumps((args, expectation, expected), protocol = pickle.HIGHEST_PROTOCOL)
+
+
+############################################
+# Zygote
+############################################
+
+
+def _reapChildren():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def _zygoteMain(listener_fd, alive_fd, address, preload):
+    for name in preload:
+        importlib.import_module(name)
+
+    listener = socket.socket(fileno = listener_fd)
+
+    try:
+        while True:
+            # the workers which exited are reaped after the marking process
+            # opened their pidfd, so that their pid cannot be reused before
+            _reapChildren()
+            readable, _, _ = select.select([listener, alive_fd], [], [], REAP_INTERVAL)
+            if alive_fd in readable:
+                # all the marking processes have exited
+                return
+            if listener not in readable:
+                continue
+
+            client, _ = listener.accept()
+            with client:
+                data, fds, _, _ = socket.recv_fds(client, 65536, 1)
+                if not fds:
+                    continue
+
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    client.close()
+                    os.close(alive_fd)
+                    _zygoteChild(fds[0], pickle.loads(data))
+
+                os.close(fds[0])
+                pidfd = os.pidfd_open(pid)
+                try:
+                    socket.send_fds(client, [struct.pack('q', pid)], [pidfd])
+                finally:
+                    os.close(pidfd)
+    finally:
+        os.unlink(address)
+        os.rmdir(os.path.dirname(address))
+
+
+def _zygoteChild(fd, limits):
+    code = 0
+    try:
+        _workerMain(Connection(fd), limits)
+    except BaseException:
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+class ZygoteProcess(object):
+    '''
+    A sandbox worker forked by a Zygote. It is not a child of the marking
+    process, so it is controlled by a pidfd opened by the zygote, which
+    keeps referring to the worker after it exits, unlike its pid.
+    '''
+
+    def __init__(self, pid, pidfd):
+        self.pid = pid
+        self.pidfd = pidfd
+
+
+    def __del__(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+
+    def is_alive(self):
+        # a pidfd is readable once its process has exited
+        return not self.join(0)
+
+
+    def terminate(self):
+        self.signal(signal.SIGTERM)
+
+
+    def kill(self):
+        self.signal(signal.SIGKILL)
+
+
+    def signal(self, signum):
+        try:
+            signal.pidfd_send_signal(self.pidfd, signum)
+        except (ProcessLookupError, PermissionError):
+            # the worker has exited, or changed its user
+            pass
+
+
+    def join(self, timeout = None):
+        '''
+        Wait until the worker exits. Returns whether it has exited.
+        '''
+        readable, _, _ = select.select([self.pidfd], [], [], timeout)
+        return bool(readable)
+
+
+class Zygote(object):
+    '''
+    A small process which imports the sandbox and the preloaded modules
+    once, and forks sandbox workers on demand. It is started as a fresh
+    interpreter, so the start up time of a worker does not depend on how
+    much memory the marking process has grown, and each worker starts with
+    the preloaded modules already imported.
+
+    The zygote exits once the process which created it, and the processes
+    forked from that process such as the markFolder() workers, have exited.
+    '''
+
+    def __init__(self, preload = []):
+        '''
+        Start a new zygote.
+
+        Parameters
+        ----------
+        preload : list of str
+            the names of the modules imported by the zygote, such as the
+            dependencies of the assignments. The modules of the sandbox
+            are always imported
+        '''
+        package = __name__.rpartition('.')[0]
+        self.preload = [package + '.functions'] + list(preload)
+        self.address = os.path.join(tempfile.mkdtemp(prefix = 'automarker-'), 'zygote')
+
+        listener = socket.socket(socket.AF_UNIX)
+        listener.bind(self.address)
+        listener.listen()
+
+        # the zygote exits when every copy of alive_w is closed
+        alive_r, self.alive_w = os.pipe()
+        command = ('import sys, json; sys.path[:] = json.loads(sys.argv[1]); '
+                   'from {} import _zygoteMain; '
+                   '_zygoteMain({}, {}, {!r}, json.loads(sys.argv[2]))').format(
+                       __name__, listener.fileno(), alive_r, self.address)
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, '-c', command, json.dumps(sys.path), json.dumps(self.preload)],
+                pass_fds = [listener.fileno(), alive_r], stdin = subprocess.DEVNULL)
+        finally:
+            listener.close()
+            os.close(alive_r)
+
+
+    def fork(self, limits):
+        '''
+        Fork a new sandbox worker. It can be called from any thread, and
+        from the processes forked from the one which started the zygote.
+
+        Parameters
+        ----------
+        limits : SandboxLimits
+            the resource limits of the worker
+
+        Returns
+        -------
+        tuple:
+            (connection to the worker, ZygoteProcess)
+
+        Raises
+        ------
+        SandboxError:
+            if the zygote is not running
+        '''
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(self.address)
+                socket.send_fds(client, [pickle.dumps(limits)], [child_sock.fileno()])
+                reply, fds, _, _ = socket.recv_fds(client, 8, 1)
+        except OSError as err:
+            parent_sock.close()
+            raise SandboxError('the zygote is not running: {}'.format(err))
+        finally:
+            child_sock.close()
+
+        if len(reply) < 8 or not fds:
+            for fd in fds:
+                os.close(fd)
+            parent_sock.close()
+            raise SandboxError('the zygote is not running')
+
+        pid, = struct.unpack('q', reply)
+        return Connection(parent_sock.detach()), ZygoteProcess(pid, fds[0])
+
+
+    def forkTask(self, limits, assignment, func, args):
+        '''
+        Fork a new sandbox worker which runs a single task, such as
+        a unittest class, then exits.
+
+        Parameters
+        ----------
+        limits : SandboxLimits
+            the resource limits of the worker
+        assignment : Assignment
+            the assignment, whose code and dependencies are loaded by the worker
+        func : function
+            module level function, called by the worker as
+            func(connection, limits, (code, dependency modules), *args)
+        args : tuple
+            the other parameters of func, which can be pickled
+
+        Returns
+        -------
+        tuple:
+            (connection to the worker, ZygoteProcess), see fork()
+        '''
+        conn, process = self.fork(limits)
+        try:
+            conn.send((TASK, assignment.key, assignment.marshaled_code,
+                       [d.__name__ for d in assignment.dependencies], None, (func, args), False))
+        except (OSError, EOFError):
+            process.kill()
+            raise SandboxError('the zygote worker has exited')
+
+        return conn, process
+
+
+    def close(self):
+        '''
+        Stop the zygote. The workers it forked are not stopped.
+        '''
+        if self.alive_w is not None:
+            os.close(self.alive_w)
+            self.alive_w = None
+
+        self.process.terminate()
+        self.process.wait()
+
+
+############################################
+# Workers
+############################################
+
+
+class SandboxWorker(object):
+    '''
+    A long-lived process which runs test cases sent over a pipe.
+    '''
+
+    def __init__(self, limits = None, zygote = None):
+        started = time.perf_counter()
+        limits = limits or SandboxLimits()
+        if zygote is not None:
+            self.conn, self.process = zygote.fork(limits)
+        else:
+            self.conn, child_conn = mp.Pipe()
+            self.process = mp.Process(target = _workerMain, args = (child_conn, limits))
+            self.process.daemon = True
+            self.process.start()
+            child_conn.close()
+
+        # the start up time, charged to the first case of this worker
+        self.spawn_time = time.perf_counter() - started
+
+
+    def takeSpawnTime(self):
+        spawn_time, self.spawn_time = self.spawn_time, 0.0
+        return spawn_time
+
+
+    def send(self, message):
+        '''
+        Send a message to this worker.
+
+        Parameters
+        ----------
+        message : tuple
+            (kind, key, marshaled code, dependency names, function name, payload)
+        '''
+        try:
+            self.conn.send(message)
+        except (OSError, EOFError):
+            raise SandboxCrashed()
+
+
+    def receive(self, timeout):
+        '''
+        Wait for the next reply of this worker.
+
+        Parameters
+        ----------
+        timeout : float
+            the maximum waiting time in seconds
+
+        Returns
+        -------
+        tuple:
+            the reply
+        '''
+        if not self.conn.poll(timeout):
+            raise SandboxTimeout()
+
+        try:
+            return self.conn.recv()
+        except (OSError, EOFError):
+            raise SandboxCrashed()
+
+
+    async def receiveAsync(self, timeout):
+        '''
+        Wait for the next reply of this worker without blocking the event
+        loop, see receive().
+        '''
+        if not await waitReadable(self.conn, timeout):
+            raise SandboxTimeout()
+
+        return self.receive(0)
+
+
+    def isAlive(self):
+        return self.process.is_alive()
+
+
+    def kill(self):
+        '''
+        Stop this worker immediately.
+        '''
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(0.1)
+
+        while self.process.is_alive():
+            self.process.kill()
+            self.process.join(0.1)
+
+
+    def close(self):
+        '''
+        Ask this worker to exit once it has finished its current case.
+        '''
+        self.conn.close()
+        self.process.join(0.1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class SandboxPool(object):
+    '''
+    A pool of warm sandbox workers shared by function checkers.
+
+    A worker is reused for every case until a case times out or
+    crashes it, then it is replaced by a fresh one.
+    '''
+
+    def __init__(self, size = None, limits = None, zygote = None):
+        '''
+        Create a new sandbox pool.
+
+        Parameters
+        ----------
+        size : int
+            the maximum number of idle workers kept alive,
+            the number of cores is used by default
+        limits : SandboxLimits
+            the resource limits of the workers
+        zygote : Zygote
+            if it is given, the workers are forked by it instead of
+            by the marking process
+        '''
+        self.size = size or mp.cpu_count()
+        self.limits = limits
+        self.zygote = zygote
+        self.idle = []
+        self.workers = set()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        with self.lock:
+            while self.idle:
+                worker = self.idle.pop()
+                if worker.isAlive():
+                    return worker
+
+                self.workers.discard(worker)
+                worker.kill()
+
+        worker = SandboxWorker(self.limits, self.zygote)
+        with self.lock:
+            self.workers.add(worker)
+
+        return worker
+
+
+    def release(self, worker):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(worker)
+                return
+
+            self.workers.discard(worker)
+
+        worker.close()
+
+
+    def discard(self, worker):
+        with self.lock:
+            self.workers.discard(worker)
+
+        worker.kill()
+
+
+    def call(self, assignment, func_name, args, timeout, profile = False):
+        '''
+        Run a function of an assignment on a warm worker. The worker
+        unmarshals the compiled code once and keeps it for the following
+        cases of the same assignment, and runs each case in a throwaway
+        child, see _isolatedCall().
+
+        Parameters
+        ----------
+        assignment : Assignment
+            the assignment, whose dependency modules must be importable
+            by their names inside the worker
+        func_name : str
+            the name of function to be called
+        args : tuple
+            the input parameters
+        timeout : float
+            the maximum running time in seconds
+        profile : bool
+            whether the function is profiled, the hotspots of the submission
+            are the profile of the timing, see profileHotspots()
+
+        Returns
+        -------
+        tuple:
+            (success, modified parameters, return value, timing, limit),
+            see caseTiming() for the timing, limit is the resource whose
+            limit was exceeded or None, see SandboxLimits.exceeded()
+
+        Raises
+        ------
+        SandboxTimeout
+            if the case does not finish in time
+        SandboxCrashed
+            if the worker dies while running the case
+        The timing of the case is set as the timing attribute of the error.
+        '''
+        message = (CALL, assignment.key, assignment.marshaled_code,
+                   [d.__name__ for d in assignment.dependencies], func_name, args, profile)
+
+        started = time.perf_counter()
+        worker = self.acquire()
+        spawn = worker.takeSpawnTime()
+        try:
+            worker.send(message)
+            success, post_args, r, (wall, cpu, output, hotspots), limit = worker.receive(timeout)
+        except SandboxError as err:
+            self.discard(worker)
+            err.timing = caseTiming(time.perf_counter() - started, spawn = spawn,
+                                    timeout = isinstance(err, SandboxTimeout))
+            raise
+        except BaseException:
+            self.discard(worker)
+            raise
+
+        self.release(worker)
+        return success, post_args, r, caseTiming(
+            time.perf_counter() - started, wall, cpu, spawn, output = output,
+            profile = hotspots), limit
+
+
+    def runBatch(self, assignment, func_name, cases, profile = False):
+        '''
+        Run a batch of test cases of a function in one sandbox. The cases
+        are sent in one message and checked in order inside the sandbox,
+        each one against its own deadline. A case which times out or
+        crashes the worker fails, and the rest of the batch is sent
+        to a fresh worker.
+
+        Parameters
+        ----------
+        assignment : Assignment
+            the assignment
+        func_name : str
+            the name of function to be called
+        cases : list of tuple
+            (args, expectation, expected value, timeout) of each case,
+            see FunctionTestCase.expect(), followed by the case pickled
+            by pickleCase() if it was pickled beforehand
+        profile : bool
+            whether the cases are profiled, see call()
+
+        Yields
+        ------
+        tuple:
+            (index of case, whether it passed, FailedReturn of the return
+            value if it failed, timing, limit), see call()
+        '''
+        index = 0
+
+        while index < len(cases):
+            pending = cases[index:]
+            started = time.perf_counter()
+            worker = self.acquire()
+            spawn = worker.takeSpawnTime()
+            try:
+                worker.send(_batchMessage(assignment, func_name, pending, profile))
+                for case in pending:
+                    passed, r, (wall, cpu, compare, output, hotspots), limit = \
+                        worker.receive(case[3])
+                    timing = caseTiming(time.perf_counter() - started, wall, cpu, spawn, compare,
+                                        output = output, profile = hotspots)
+
+                    index += 1
+                    yield index - 1, passed, r, timing, limit
+                    started, spawn = time.perf_counter(), 0.0
+            except SandboxError as err:
+                self.discard(worker)
+                timing = caseTiming(time.perf_counter() - started, spawn = spawn,
+                                    timeout = isinstance(err, SandboxTimeout))
+                index += 1
+                yield index - 1, False, None, timing, None
+                continue
+            except BaseException:
+                self.discard(worker)
+                raise
+
+            self.release(worker)
+
+
+    async def runBatchAsync(self, assignment, func_name, cases, profile = False):
+        '''
+        Run a batch of test cases like runBatch(), waiting for the replies
+        without blocking the event loop. A cancelled batch kills its worker.
+        '''
+        index = 0
+
+        while index < len(cases):
+            pending = cases[index:]
+            started = time.perf_counter()
+            worker = self.acquire()
+            spawn = worker.takeSpawnTime()
+            try:
+                worker.send(_batchMessage(assignment, func_name, pending, profile))
+                for case in pending:
+                    passed, r, (wall, cpu, compare, output, hotspots), limit = \
+                        await worker.receiveAsync(case[3])
+                    timing = caseTiming(time.perf_counter() - started, wall, cpu, spawn, compare,
+                                        output = output, profile = hotspots)
+
+                    index += 1
+                    yield index - 1, passed, r, timing, limit
+                    started, spawn = time.perf_counter(), 0.0
+            except SandboxError as err:
+                self.discard(worker)
+                timing = caseTiming(time.perf_counter() - started, spawn = spawn,
+                                    timeout = isinstance(err, SandboxTimeout))
+                index += 1
+                yield index - 1, False, None, timing, None
+                continue
+            except BaseException:
+                self.discard(worker)
+                raise
+
+            self.release(worker)
+
+
+    def close(self):
+        '''
+        Stop all the workers of this pool.
+        '''
+        with self.lock:
+            workers = list(self.workers)
+            self.workers.clear()
+            self.idle = []
+
+        for worker in workers:
+            worker.kill()
+
+
+    def _forget(self):
+        # called in a forked child: the workers belong to the parent
+        for worker in self.workers:
+            worker.conn.close()
+
+        self.workers = set()
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+_default_pool = None
+
+def defaultPool():
+    '''
+    Get the sandbox pool shared by every checker of this process.
+
+    Returns
+    -------
+    SandboxPool:
+        the shared pool
+    '''
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = SandboxPool()
+
+    return _default_pool
+
+
+def configureDefaultPool(size = None, limits = None, zygote = None):
+    '''
+    Replace the sandbox pool shared by every checker of this process.
+
+    Parameters
+    ----------
+    size : int
+        see SandboxPool
+    limits : SandboxLimits
+        the resource limits of the workers
+    zygote : Zygote
+        the zygote forking the workers, see SandboxPool
+    '''
+    global _default_pool
+    _closeDefaultPool()
+    _default_pool = SandboxPool(size, limits, zygote)
+    return _default_pool
+
+
+def _closeDefaultPool():
+    if _default_pool is not None:
+        _default_pool.close()
+
+
+def _forgetDefaultPool():
+    # a forked child keeps the size, limits and zygote of the pool, not its workers
+    if _default_pool is not None:
+        _default_pool._forget()
+
+
+atexit.register(_closeDefaultPool)
+os.register_at_fork(after_in_child = _forgetDefaultPool)
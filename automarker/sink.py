@@ -0,0 +1,89 @@
+import gzip
+import json
+import os
+import zlib
+
+
+class JsonLinesSink(object):
+    '''
+    Stream of marking records, written as one JSON object per line.
+
+    Each record is handed to the operating system as soon as it is written,
+    so the file can be read while marking is still running, and nothing is
+    kept in memory. The file is synced to the disk every fsync_every records
+    and when the sink is closed. Compressed files are flushed after each
+    record as well, so readers can decompress all the records written so far.
+    '''
+
+    def __init__(self, path, compress = False, fsync_every = 100):
+        '''
+        Create a new sink. Records are appended if the file exists.
+
+        Parameters
+        ----------
+        path : str
+            path of the output file
+        compress : bool
+            if it is true, the file is written with gzip
+        fsync_every : int
+            the number of records written between two syncs to the disk,
+            the file is only synced when it is closed if it is 0
+        '''
+        self.path = path
+        self.compress = compress
+        self.fsync_every = fsync_every
+        self.count = 0
+        self.unsynced = 0
+
+        self.file = open(path, 'ab')
+        if compress:
+            self.out = gzip.GzipFile(fileobj = self.file, mode = 'ab')
+        else:
+            self.out = self.file
+
+
+    def write(self, record):
+        '''
+        Write a record. Values which cannot be serialized as JSON are
+        written as their repr().
+
+        Parameters
+        ----------
+        record : dict
+            the record, see marker.markRecord()
+        '''
+        line = json.dumps(record, default = repr) + '\n'
+        self.out.write(line.encode('utf-8'))
+        if self.compress:
+            self.out.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            self.out.flush()
+
+        self.count += 1
+        self.unsynced += 1
+        if self.fsync_every and self.unsynced >= self.fsync_every:
+            self.sync()
+
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        if self.compress:
+            self.out.close()
+        self.sync()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+'''
+Generate a synthetic corpus of submissions shaped like assignment.py.
+
+Each submission is one of the KINDS below, and small variations (variable
+names, comments) make every file of a kind different.
+'''
+
+import argparse
+import os
+import random
+
+MENTIONS = '''def extract_mentions(tweet):
+    \'\'\' (str) -> list of str
+    \'\'\'
+    {lst} = []
+    i = 0
+    while i < len(tweet) and tweet.find('@', i) != -1:
+        start = tweet.find('@', i)
+        end = tweet.find(' ', start){slow}{output}
+        if end != -1:
+            {lst}.append(tweet[start + {offset}: end])
+        else:
+            {lst}.append(tweet[start + {offset}:])
+            end = len(tweet)
+        {advance}
+    return {lst}
+
+'''
+
+HASHTAGS = '''def extract_hashtags(tweet):
+    \'\'\' (str) -> list of str
+    \'\'\'
+    {lst} = []
+    for word in tweet.split():
+        if word.startswith('#') and word[1:] not in {lst}:
+            {lst}.append(word[1:])
+    return {lst}
+
+'''
+
+COUNT_WORDS = '''def count_words(tweet, word_dict):
+    \'\'\' (str, dict of {{str: int}}) -> NoneType
+    \'\'\'
+    for word in tweet.split():
+        if word[0] != '@' and word[0] != '#':
+            {word} = ''
+            for s in word:
+                if s.isalpha() or s.isdigit():
+                    {word} += s{lower}
+            if {word} != '':
+                word_dict[{word}] = word_dict.get({word}, 0) + 1
+
+'''
+
+HELPER = '''def helper_{index}(values):
+    \'\'\' (list of int) -> int
+    \'\'\'
+    total = 0
+    for value in values:
+        if value % {modulo} == 0:
+            total += value
+        else:
+            total -= 1
+    return total
+
+'''
+
+# the kinds of submissions, see submission()
+KINDS = ['correct', 'wrong', 'slow', 'loop', 'output', 'long']
+
+NAMES = ['lst', 'result', 'found', 'names', 'items', 'answer']
+
+
+def submission(kind, rng):
+    '''
+    Generate the source code of a submission.
+
+    Parameters
+    ----------
+    kind : str
+        correct: passes all the test cases
+        wrong: returns wrong values
+        slow: correct, but busy for a while in each call
+        loop: never returns for a tweet with a mention
+        output: correct, but prints a lot in each call
+        long: correct, with thousands of lines of helper functions
+    rng : random.Random
+        the source of the variations
+
+    Returns
+    -------
+    str:
+        source code
+    '''
+    mentions = {
+        'lst'    : rng.choice(NAMES),
+        'slow'   : '',
+        'output' : '',
+        'offset' : 1,
+        'advance': 'i = end'
+    }
+    indent = '\n        '
+    if kind == 'wrong':
+        mentions['offset'] = 0
+    elif kind == 'slow':
+        mentions['slow'] = indent + 'for _ in range({}):'.format(rng.randint(100000, 200000)) + \
+                           indent + '    start = start'
+    elif kind == 'loop':
+        mentions['advance'] = 'i = i'
+    elif kind == 'output':
+        mentions['output'] = indent + 'print(tweet * {})'.format(rng.randint(5000, 10000))
+
+    code = '# submission {}\n\n'.format(rng.getrandbits(32))
+    code += MENTIONS.format(**mentions)
+    code += HASHTAGS.format(lst = rng.choice(NAMES))
+    code += COUNT_WORDS.format(word = rng.choice(['w', 'word_', 'clean']),
+                               lower = '' if kind == 'wrong' else '.lower()')
+
+    if kind == 'long':
+        for index in range(rng.randint(300, 500)):
+            code += HELPER.format(index = index, modulo = rng.randint(2, 9))
+
+    return code
+
+
+def generate(directory, count = 5, seed = 0, kinds = KINDS):
+    '''
+    Write count submissions of each kind into a directory.
+
+    Returns
+    -------
+    list:
+        (kind, file path) of each submission
+    '''
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok = True)
+
+    files = []
+    for kind in kinds:
+        for index in range(count):
+            filepath = os.path.join(directory, '{}_{:03d}.py'.format(kind, index))
+            with open(filepath, 'w') as fout:
+                fout.write(submission(kind, rng))
+            files.append((kind, filepath))
+
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('directory')
+    parser.add_argument('--count', type = int, default = 5, help = 'submissions of each kind')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    files = generate(args.directory, args.count, args.seed)
+    print('{} submissions written to {}'.format(len(files), args.directory))
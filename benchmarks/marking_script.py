@@ -0,0 +1,37 @@
+import os
+
+from automarker.compilation import *
+from automarker.functions import FunctionChecker, UnittestChecker
+from automarker.marker import Assignment
+
+
+def mark(base_dir, code):
+    # create an assignment
+    a = Assignment(code)
+
+    # printing is allowed, so that submissions with huge outputs are run
+    compiled = CompilationChecker(a) \
+        .should(FollowFormattingStyle(), 'Checking Format') \
+        .should(NotUseImports(['doctest']), 'Do not import any modules') \
+        .should(NotUseInput(), 'Do not use any input function') \
+        .should(HaveDocstrings(), 'Should have docstring for the functions') \
+        .check()
+
+    if compiled:
+        FunctionChecker(a, 'extract_mentions') \
+            .newCase().when('').shouldReturnType(list) \
+            .newCase().when('').shouldReturn([]) \
+            .newCase().when('@a').shouldReturn(['a']) \
+            .newCase().when(' @ab').shouldReturn(['ab'])
+
+        FunctionChecker(a, 'extract_hashtags') \
+            .newCase().when('').shouldReturnType(list) \
+            .newCase().when('#a #b #a').shouldReturn(['a', 'b'])
+
+        FunctionChecker(a, 'count_words') \
+            .newCase().when('aaa bbb aaa', {}).shouldNotReturn() \
+            .newCase().when('aaa bbb aaa', {}).shouldModifyParams('aaa bbb aaa', {'aaa': 2, 'bbb': 1})
+
+        UnittestChecker(a, os.path.join(base_dir, 'tweets_tests.py')).check()
+
+    return a.generateReport()
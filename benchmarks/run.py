@@ -0,0 +1,312 @@
+#! /usr/bin/env python3
+'''
+Benchmark the stages of marking on a synthetic corpus, see corpus.py.
+
+Each stage is timed once per submission, and its latency percentiles and
+throughput are reported. Results can be saved as a baseline, and compared
+with a baseline to catch regressions:
+
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 0.2
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from automarker import __version__
+from automarker.compilation import *
+from automarker.functions import FunctionChecker, UnittestChecker, loadFunc
+from automarker.marker import Assignment, mark, markFolder
+
+import corpus
+
+SCRIPT_PATH = os.path.join(BENCH_DIR, 'marking_script.py')
+UNITTEST_PATH = os.path.join(BENCH_DIR, 'tweets_tests.py')
+
+# (arguments, expected return value) of the test cases run by the run stage
+CASES = [(('',), []), (('@a',), ['a']), (('hi @a and @b',), ['a', 'b']),
+         (('@' + 'a' * 50 + ' #b ' * 20,), ['a' * 50])]
+
+STAGES = ['compilation', 'loadFunc', 'run', 'unittest', 'pipeline', 'markFolder']
+
+# a slower or less productive stage than the baseline is a regression
+LATENCY_METRICS = ['mean', 'p50', 'p95']
+THROUGHPUT_METRICS = ['throughput']
+
+
+@contextlib.contextmanager
+def quietStdout():
+    '''
+    Send the output of the submissions, and of the sandboxes forked
+    in this context, to /dev/null.
+    '''
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed = None):
+    '''
+    Summarize the latencies of a stage.
+
+    Parameters
+    ----------
+    latencies : list of float
+        seconds taken by each call
+    elapsed : float
+        the wall time of the whole stage, the sum of the latencies by default
+
+    Returns
+    -------
+    dict:
+        count, total seconds, throughput in calls per second, and mean,
+        p50, p95 and max latency in seconds
+    '''
+    values = sorted(latencies)
+    total = sum(values) if elapsed is None else elapsed
+    return {
+        'count'     : len(values),
+        'total'     : total,
+        'throughput': len(values) / total if total > 0 else 0.0,
+        'mean'      : total / len(values) if values else 0.0,
+        'p50'       : percentile(values, 0.5) if values else 0.0,
+        'p95'       : percentile(values, 0.95) if values else 0.0,
+        'max'       : values[-1] if values else 0.0
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+############################################
+# Stages
+############################################
+
+
+def compilationStage(files, timeout):
+    def check(code):
+        CompilationChecker(Assignment(code)) \
+            .should(FollowFormattingStyle(), 'Checking Format') \
+            .should(NotUseImports(['doctest']), 'Do not import any modules') \
+            .should(NotUseInput(), 'Do not use any input function') \
+            .should(HaveDocstrings(), 'Should have docstring for the functions') \
+            .check()
+
+    return [timed(check, code) for _, code in files]
+
+
+def loadFuncStage(files, timeout):
+    return [timed(loadFunc, Assignment(code), 'extract_mentions') for _, code in files]
+
+
+def runStage(files, timeout):
+    # the cases are recorded by a deferred checker and run like the checkers
+    # of a marking script, with their expectations checked in the sandbox
+    latencies = []
+    for _, code in files:
+        checker = FunctionChecker(Assignment(code), 'extract_mentions', deferred = True)
+        for args, expected in CASES:
+            case = checker.newCase().when(*args)
+            case.max_running_time = timeout
+            case.shouldReturn(expected)
+            latencies.append(timed(case.runChecked))
+
+    return latencies
+
+
+def unittestStage(files, timeout):
+    def check(code):
+        UnittestChecker(Assignment(code), UNITTEST_PATH, max_running_time = timeout).check()
+
+    return [timed(check, code) for _, code in files]
+
+
+def pipelineStage(files, timeout):
+    return [timed(mark, code, SCRIPT_PATH) for _, code in files]
+
+
+STAGE_FUNCS = {
+    'compilation': compilationStage,
+    'loadFunc'   : loadFuncStage,
+    'run'        : runStage,
+    'unittest'   : unittestStage,
+    'pipeline'   : pipelineStage
+}
+
+
+def runBenchmarks(directory, count, seed, timeout, stages, processes):
+    '''
+    Generate a corpus and time each stage on it.
+
+    Returns
+    -------
+    dict:
+        the summary of each stage, see summarize(), and the summary of
+        each stage for each kind of submission
+    '''
+    files = []
+    for kind, filepath in corpus.generate(directory, count, seed):
+        with open(filepath) as fin:
+            files.append((kind, fin.read()))
+
+    results = {'stages': {}, 'kinds': {}}
+    for stage in stages:
+        if stage == 'markFolder':
+            with quietStdout():
+                summary = markFolder(directory, SCRIPT_PATH, processes = processes)
+            results['stages'][stage] = summarize([summary['elapsed'] / summary['total']] *
+                                                 summary['total'], summary['elapsed'])
+            continue
+
+        # warm up, the sandbox workers are started on the first call
+        correct = [f for f in files if f[0] == 'correct'][:1]
+        with quietStdout():
+            STAGE_FUNCS[stage](correct, timeout)
+
+        latencies = []
+        for kind in corpus.KINDS:
+            of_kind = [f for f in files if f[0] == kind]
+            with quietStdout():
+                kind_latencies = STAGE_FUNCS[stage](of_kind, timeout)
+            results['kinds'].setdefault(stage, {})[kind] = summarize(kind_latencies)
+            latencies += kind_latencies
+
+        results['stages'][stage] = summarize(latencies)
+
+    return results
+
+
+############################################
+# Reporting
+############################################
+
+
+def formatResults(results):
+    lines = ['{:<12} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stage', 'count', 'per sec', 'mean ms', 'p50 ms', 'p95 ms', 'max ms')]
+
+    def line(name, s):
+        return '{:<12} {:>6} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            name, s['count'], s['throughput'],
+            s['mean'] * 1000, s['p50'] * 1000, s['p95'] * 1000, s['max'] * 1000)
+
+    for stage, summary in results['stages'].items():
+        lines.append(line(stage, summary))
+        for kind, kind_summary in results['kinds'].get(stage, {}).items():
+            lines.append(line('  ' + kind, kind_summary))
+
+    return '\n'.join(lines)
+
+
+def compareResults(baseline, results, threshold):
+    '''
+    Compare results with a baseline.
+
+    Parameters
+    ----------
+    baseline : dict
+        results saved by an earlier run
+    results : dict
+        results of this run
+    threshold : float
+        the relative change which is a regression, 0.2 for 20%
+
+    Returns
+    -------
+    list:
+        a message for each regression
+    '''
+    regressions = []
+    for stage, summary in results['stages'].items():
+        old = baseline['stages'].get(stage)
+        if old is None:
+            continue
+
+        for metric in LATENCY_METRICS:
+            if old[metric] > 0 and summary[metric] > old[metric] * (1 + threshold):
+                regressions.append('{} {}: {:.2f} ms -> {:.2f} ms (+{:.0%})'.format(
+                    stage, metric, old[metric] * 1000, summary[metric] * 1000,
+                    summary[metric] / old[metric] - 1))
+
+        for metric in THROUGHPUT_METRICS:
+            if summary[metric] < old[metric] / (1 + threshold):
+                regressions.append('{} {}: {:.1f}/s -> {:.1f}/s ({:.0%})'.format(
+                    stage, metric, old[metric], summary[metric],
+                    summary[metric] / old[metric] - 1))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type = int, default = 5, help = 'submissions of each kind')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--timeout', type = float, default = 1.0,
+                        help = 'deadline of a test case in seconds')
+    parser.add_argument('--stages', default = ','.join(STAGES),
+                        help = 'comma separated stages among ' + ', '.join(STAGES))
+    parser.add_argument('--processes', type = int, default = None,
+                        help = 'marking processes of the markFolder stage')
+    parser.add_argument('--corpus', help = 'directory of the corpus, temporary by default')
+    parser.add_argument('--save', help = 'save the results as a baseline')
+    parser.add_argument('--compare', help = 'compare the results with a baseline')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+                        help = 'relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage: ' + stage)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = runBenchmarks(args.corpus or tmp, args.count, args.seed,
+                                args.timeout, stages, args.processes)
+
+    results['environment'] = {
+        'automarker': __version__,
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'cpus'      : os.cpu_count()
+    }
+    print(formatResults(results))
+
+    if args.save:
+        with open(args.save, 'w') as fout:
+            json.dump(results, fout, indent = 1)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            regressions = compareResults(json.load(fin), results, args.threshold)
+
+        if regressions:
+            print('\nRegressions over {:.0%}:'.format(args.threshold))
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('\nNo regression over {:.0%}'.format(args.threshold))
@@ -0,0 +1,26 @@
+import unittest
+
+
+class TestExtractMentions(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(extract_mentions(''), [])
+
+    def test_one(self):
+        self.assertEqual(extract_mentions('@a'), ['a'])
+
+    def test_many(self):
+        self.assertEqual(extract_mentions('hi @a and @b'), ['a', 'b'])
+
+
+class TestCountWords(unittest.TestCase):
+
+    def test_basic(self):
+        d = {}
+        count_words('aaa bbb aaa', d)
+        self.assertEqual(d, {'aaa': 2, 'bbb': 1})
+
+    def test_mixed(self):
+        d = {'aaa': 1}
+        count_words('AAA @bbb #ccc d!', d)
+        self.assertEqual(d, {'aaa': 2, 'd': 1})